@@ -0,0 +1,518 @@
+"""离线基准测试：用本地假服务替代 DNS、ipinfo 和远端节点，按不同规模测量主流程各阶段的耗时和吞吐。
+
+    python benchmark.py --scales 1000,10000,100000 --json bench.json
+    python benchmark.py --scales 100000 --processes 1,2,4,8 --farm-processes 8   # 多进程扩展性
+    python benchmark.py --scales 1000 --stages tcp,tls,http                      # 含 TLS 阶段的分阶段探测
+
+本地节点集群监听 0.0.0.0 的单个端口，127.16.0.0 起的每个回环地址都是一个“节点”，
+按地址哈希决定其延迟、丢连接概率和带宽；--dead 比例的 IP 取自 198.18.0.0/15（RFC 2544 测试网段），无人监听。
+TCP 握手由内核在本机完成，--latency / --jitter / --loss 只作用于握手之后的 HTTP 响应和下载：
+单纯握手测延迟（不加 --stages）时 detect 测得的是回环延迟，不受这三个参数影响，含 http 阶段时才会体现。
+报告中的“均摊”是阶段耗时除以条目数，反映吞吐；各条目实测延迟的分布见 p50/p95 列。
+--stages 含 tls 时用 openssl 生成 PROBE_SNI 的自签名证书，集群另开一个 TLS 端口，探测只信任该证书。
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import dns.message
+import dns.rdatatype
+import dns.rrset
+
+from steps import (
+    collect_all_ips, detect_all_ip_country, filter_ips_by_allowed_countries, load_country_mapping,
+    process_result_csv,
+)
+from dns_harvest import DnsHarvester
+from geo_provider import build_provider
+from multiproc import scan_in_processes
+from probe import percentile
+from records import write_latency_file, write_lines_atomic
+from scanner import scan_ips, write_result_csv
+from staged_probe import PROBE_SNI
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FARM_START = (127 << 24) | (16 << 16)
+DEAD_START = (198 << 24) | (18 << 16)
+COUNTRIES = ('HK', 'SG', 'JP', 'US', 'DE', 'KR', 'GB', 'FR', 'CN', 'RU')
+
+
+def _fraction(ip, salt):
+    """把 IP 稳定地映射到 [0, 1)，同一 IP 每次运行的表现相同。"""
+    return zlib.crc32(f"{salt}|{ip}".encode()) / 0x100000000
+
+
+def _int_to_ip(value):
+    return socket.inet_ntoa(value.to_bytes(4, 'big'))
+
+
+def fake_country(ip):
+    return COUNTRIES[zlib.crc32(ip.encode()) % len(COUNTRIES)]
+
+
+def make_test_certificate(directory, hostname=PROBE_SNI):
+    """用 openssl 生成 hostname 的自签名证书，返回 (证书, 私钥) 路径；证书同时作为探测端信任的 CA。"""
+    certfile = os.path.join(directory, 'farm.crt')
+    keyfile = os.path.join(directory, 'farm.key')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', f'/CN={hostname}',
+         '-addext', f'subjectAltName=DNS:{hostname}', '-keyout', keyfile, '-out', certfile],
+        check=True, capture_output=True,
+    )
+    return certfile, keyfile
+
+
+class ListenerFarm:
+    """本地节点集群：TCP 握手由内核完成，延迟、丢连接和带宽在应用层按目标地址模拟。
+
+    支持 /cdn-cgi/trace（返回 colo=）和 /__down?bytes=N（按带宽限速下发 N 字节）。
+    给出 certfile / keyfile 时另在 tls_port 上以该证书提供同样的服务，供 TLS 阶段离线测试。
+    """
+
+    def __init__(self, latency=20, jitter=10, loss=0.02, bandwidth=16, host='0.0.0.0', processes=1,
+                 certfile=None, keyfile=None):
+        self.params = {'latency': latency, 'jitter': jitter, 'loss': loss, 'bandwidth': bandwidth, 'host': host,
+                       'certfile': certfile, 'keyfile': keyfile}
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.bandwidth = bandwidth * 1024 * 1024
+        self.host = host
+        # 大于 1 时在多个进程中用 SO_REUSEPORT 监听同一端口，避免集群本身成为多进程基准的瓶颈
+        self.processes = processes
+        self._children = []
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.port = None
+        self.tls_port = None
+        self.connections = 0
+        self._loop = None
+        self._server = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    def delay_for(self, ip):
+        return (self.latency + self.jitter * _fraction(ip, 'jitter')) / 1000
+
+    def bandwidth_for(self, ip):
+        # 带宽在 [0.25, 1.25] 倍之间浮动，让测速结果有高有低
+        return self.bandwidth * (0.25 + _fraction(ip, 'bandwidth'))
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        ip = writer.get_extra_info('sockname')[0]
+        try:
+            if _fraction(ip, 'loss') < self.loss:
+                # SO_LINGER=0 让关闭时直接发 RST，模拟中途断开
+                sock = writer.get_extra_info('socket')
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                return
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            await asyncio.sleep(self.delay_for(ip))
+            target = head.split(b"\r\n", 1)[0].split()[1].decode(errors='replace')
+            parts = urlsplit(target)
+            if parts.path == '/cdn-cgi/trace':
+                body = f"ip={ip}\ncolo=HKG\nloc={fake_country(ip)}\n".encode()
+                # 头和正文分开发送，像真实服务器一样可能落在不同的 TCP 段里，探测端必须读完整个响应
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body))
+                await writer.drain()
+                await asyncio.sleep(0.005)
+                writer.write(body)
+            elif parts.path == '/__down':
+                size = int(parse_qs(parts.query).get('bytes', ['1048576'])[0])
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % size)
+                await self._send_throttled(writer, size, self.bandwidth_for(ip))
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def _send_throttled(self, writer, size, rate):
+        chunk = b"\0" * 64 * 1024
+        start = time.perf_counter()
+        sent = 0
+        while sent < size:
+            piece = chunk[:min(len(chunk), size - sent)]
+            writer.write(piece)
+            await writer.drain()
+            sent += len(piece)
+            ahead = sent / rate - (time.perf_counter() - start)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+    def _run(self, port=0, tls_port=0, reuse_port=None):
+        self._loop = asyncio.new_event_loop()
+        servers = [self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, port, backlog=4096, reuse_port=reuse_port))]
+        self.port = servers[0].sockets[0].getsockname()[1]
+        if self.certfile:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            servers.append(self._loop.run_until_complete(asyncio.start_server(
+                self._handle, self.host, tls_port, ssl=context, backlog=4096, reuse_port=reuse_port)))
+            self.tls_port = servers[1].sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        for server in servers:
+            server.close()
+            self._loop.run_until_complete(server.wait_closed())
+        self._loop.close()
+
+    def start(self):
+        if self.processes > 1:
+            return self._start_processes()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def _start_processes(self):
+        # 先占住端口号，各子进程以 reuse_port 绑定同一端口后再释放
+        holders = []
+        for _ in range(2 if self.certfile else 1):
+            holder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            holder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            holder.bind((self.host, 0))
+            holders.append(holder)
+        self.port = holders[0].getsockname()[1]
+        self.tls_port = holders[1].getsockname()[1] if self.certfile else None
+        for _ in range(self.processes):
+            ready = multiprocessing.Event()
+            child = multiprocessing.Process(target=_serve_farm, args=(self.params, self.port, self.tls_port or 0, ready),
+                                            daemon=True)
+            child.start()
+            ready.wait()
+            self._children.append(child)
+        for holder in holders:
+            holder.close()
+        return self
+
+    def stop(self):
+        if self._children:
+            for child in self._children:
+                child.terminate()
+                child.join()
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def _serve_farm(params, port, tls_port, ready):
+    farm = ListenerFarm(**params)
+    threading.Thread(target=lambda: (farm._ready.wait(), ready.set()), daemon=True).start()
+    farm._run(port, tls_port, reuse_port=True)
+
+
+class _GeoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, data):
+        body = json.dumps(data).encode()
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.requests += 1
+
+    def do_GET(self):
+        ip = urlsplit(self.path).path.strip('/').split('/')[0]
+        self._reply({'ip': ip, 'country': fake_country(ip)})
+
+    def do_POST(self):
+        keys = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self._reply({key: fake_country(key.rsplit('/', 1)[0]) for key in keys})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGeoServer(ThreadingHTTPServer):
+    """模拟 ipinfo 的 /{ip}/json 和 /batch 接口，国家由 IP 哈希决定。"""
+
+    daemon_threads = True
+
+    def __init__(self, delay=0.0):
+        super().__init__(('127.0.0.1', 0), _GeoHandler)
+        self.delay = delay
+        self.requests = 0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _DnsHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        ips = self.server.zone.get(question.name.to_text().rstrip('.'), ())
+        if question.rdtype == dns.rdatatype.A and ips:
+            response.answer.append(dns.rrset.from_text_list(question.name, 300, 'IN', 'A', ips))
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+class StubDnsServer(socketserver.ThreadingUDPServer):
+    """只应答 zone 中域名 A 记录的 UDP DNS 服务。"""
+
+    daemon_threads = True
+
+    def __init__(self, zone):
+        super().__init__(('127.0.0.1', 0), _DnsHandler)
+        self.zone = zone
+        self.port = self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def latency_percentiles(values):
+    """各条目实测延迟（毫秒）的 p50 / p95 / p99，没有样本时返回 None。"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return {f"p{pct}": round(percentile(ordered, pct), 2) for pct in (50, 95, 99)}
+
+
+def build_dataset(scale, workdir, dns_share=0.1, ips_per_domain=4, dead=0.02):
+    """生成 scale 个候选 IP：大部分以 /24 CIDR 写入手动输入文件，dns_share 的部分由假域名解析得到。"""
+    dead_count = int(scale * dead)
+    live_count = scale - dead_count
+    dns_count = int(scale * dns_share) // ips_per_domain * ips_per_domain
+    manual_count = live_count - dns_count
+    manual_file = os.path.join(workdir, 'Manual_input_IP.txt')
+    domains_file = os.path.join(workdir, 'domains.txt')
+    lines = []
+    for start in range(0, manual_count, 256):
+        size = min(256, manual_count - start)
+        first = _int_to_ip(FARM_START + start)
+        lines.append(f"{first}/24" if size == 256 else f"{first}-{_int_to_ip(FARM_START + start + size - 1)}")
+    lines.extend(_int_to_ip(DEAD_START + i) for i in range(dead_count))
+    write_lines_atomic(manual_file, lines)
+    zone = {}
+    for i in range(dns_count // ips_per_domain):
+        offset = FARM_START + manual_count + i * ips_per_domain
+        zone[f"node{i}.bench.test"] = [_int_to_ip(offset + j) for j in range(ips_per_domain)]
+    write_lines_atomic(domains_file, list(zone))
+    return manual_file, domains_file, zone
+
+
+class StageTimer:
+    """记录每个阶段的耗时和处理量；非 verbose 时吞掉各阶段的打印输出。
+
+    ms_per_item 是阶段耗时按条目均摊的值，并发执行时远小于单个条目的实际延迟；
+    探测和测速阶段另在 latency_ms 中记录各条目实测延迟的分位数。
+    """
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name, items, processes=1):
+        output = contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+        entry = {'stage': name, 'items': items, 'processes': processes, 'latency_ms': None}
+        start = time.perf_counter()
+        with output:
+            yield entry
+        elapsed = time.perf_counter() - start
+        entry['seconds'] = round(elapsed, 3)
+        entry['per_second'] = round(entry['items'] / elapsed, 1) if elapsed > 0 else None
+        entry['ms_per_item'] = round(elapsed * 1000 / entry['items'], 3) if entry['items'] else None
+        self.stages.append(entry)
+
+
+def run_scale(scale, args, farm, geo, workdir):
+    manual_file, domains_file, zone = build_dataset(scale, workdir, args.dns_share, dead=args.dead)
+    dns_server = StubDnsServer(zone).start()
+    timer = StageTimer(args.verbose)
+    country_mapping = load_country_mapping(os.path.join(BASE_DIR, 'countries.txt'))
+    provider = build_provider(None, offline_db=None, base_url=geo.url,
+                              token=None if args.geo_mode == 'single' else 'bench',
+                              rate=0, timeout=10, retries=3)
+    try:
+        harvester = DnsHarvester(nameservers=['127.0.0.1'], port=dns_server.port, timeout=2,
+                                 lifetime=5, workers=32, cache_file=None)
+        with timer.stage('collect', scale) as entry:
+            ip_info = collect_all_ips(manual_file, domains_file, None, harvester=harvester)
+            entry['items'] = len(ip_info)
+
+        stages = tuple(args.stages.split(',')) if args.stages else None
+        # 含 TLS 阶段时探测集群的 TLS 端口，并只信任集群的自签名证书
+        port = farm.tls_port if stages and 'tls' in stages else farm.port
+        for processes in args.processes:
+            with timer.stage('detect', len(ip_info), processes) as entry:
+                records = detect_all_ip_country(
+                    None, None, country_mapping, port=port, timeout=args.timeout, ca_file=farm.certfile,
+                    concurrency=args.concurrency, provider=provider, ip_info=ip_info,
+                    latency_samples=args.samples, stages=stages,
+                    report_file=os.path.join(workdir, 'probe_report.csv') if stages else None,
+                    processes=processes,
+                )
+                entry['latency_ms'] = latency_percentiles(
+                    record.latency.p50 for record in records if record.latency and record.latency.p50 is not None)
+
+        input_file = os.path.join(workdir, 'all_ips_with_country.txt')
+        latency_file = os.path.join(workdir, 'all_ips_latency.csv')
+        write_lines_atomic(input_file, [f"{record.address}#{record.info}" for record in records])
+        write_latency_file(latency_file, records)
+        outputs = {name: os.path.join(workdir, f"{name}.txt") for name in (
+            'allowed', 'blocked', 'allowed_info', 'blocked_info', 'unreachable', 'unreachable_info')}
+        with timer.stage('filter', len(records)):
+            filter_ips_by_allowed_countries(
+                input_file, os.path.join(BASE_DIR, 'allowed_countries.txt'),
+                outputs['allowed'], outputs['blocked'], outputs['allowed_info'], outputs['blocked_info'],
+                outputs['unreachable'], outputs['unreachable_info'], latency_file=latency_file, sort_by='p50',
+            )
+
+        with open(outputs['allowed'], 'r', encoding='utf-8') as f:
+            allowed_ips = [line.strip() for line in f if line.strip()]
+        result_csv = os.path.join(workdir, 'result.csv')
+        url = f"http://speed.bench.test:{farm.port}/__down?bytes={args.download_bytes}"
+        scan_kwargs = {'url': url, 'latency_samples': 2, 'latency_timeout': args.timeout, 'download_duration': 5}
+        # 多进程测速对全部可用IP测下载；对比多个进程数时单进程也测全部，加速比才可比
+        download_count = args.download_count if args.processes == [1] else None
+        for processes in args.processes:
+            with timer.stage('scan', len(allowed_ips), processes) as entry:
+                if processes > 1:
+                    rows = asyncio.run(scan_in_processes(allowed_ips, processes, **scan_kwargs))
+                else:
+                    rows = asyncio.run(scan_ips(allowed_ips, download_count=download_count, **scan_kwargs))
+                write_result_csv(rows, result_csv)
+                entry['latency_ms'] = latency_percentiles(
+                    row['Average Delay'] for row in rows if row['Average Delay'] is not None)
+
+        with timer.stage('process', len(rows)):
+            process_result_csv(
+                result_csv, os.path.join(workdir, 'proxyip.txt'),
+                os.path.join(workdir, 'proxyip_with_country.txt'),
+                os.path.join(BASE_DIR, 'countries.txt'), provider=provider,
+            )
+    finally:
+        dns_server.stop()
+    return timer.stages
+
+
+def add_speedup(stages):
+    """同一阶段以单进程耗时为基准计算加速比。"""
+    baseline = {entry['stage']: entry['seconds'] for entry in stages if entry['processes'] == 1}
+    for entry in stages:
+        base = baseline.get(entry['stage'])
+        entry['speedup'] = round(base / entry['seconds'], 2) if base and entry['seconds'] else None
+    return stages
+
+
+def print_report(scale, stages):
+    print(f"\n规模 {scale}:")
+    print(f"{'阶段':<10}{'进程':>6}{'数量':>10}{'耗时(s)':>10}{'吞吐(个/s)':>14}{'均摊(ms)':>10}{'加速比':>8}"
+          f"{'延迟p50/p95(ms)':>18}")
+    for entry in stages:
+        latency = entry['latency_ms']
+        latency = f"{latency['p50']}/{latency['p95']}" if latency else '-'
+        print(f"{entry['stage']:<10}{entry['processes']:>6}{entry['items']:>10}{entry['seconds']:>10}"
+              f"{entry['per_second'] or '-':>14}{entry['ms_per_item'] or '-':>10}{entry['speedup'] or '-':>8}"
+              f"{latency:>18}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="离线基准测试主流程各阶段")
+    parser.add_argument('--scales', default='1000,10000,100000', help="逗号分隔的IP规模")
+    parser.add_argument('--stages', default='', help="探测阶段，如 tcp,http；留空为单纯握手测延迟")
+    parser.add_argument('--latency', type=float, default=20, help="节点 HTTP 响应延迟（毫秒），不影响 TCP 握手")
+    parser.add_argument('--jitter', type=float, default=10, help="响应延迟抖动上限（毫秒），不影响 TCP 握手")
+    parser.add_argument('--loss', type=float, default=0.02, help="握手后直接断开连接的节点比例，不影响 TCP 握手")
+    parser.add_argument('--bandwidth', type=float, default=16, help="节点平均带宽（MB/s）")
+    parser.add_argument('--dead', type=float, default=0.02, help="无人监听的IP比例")
+    parser.add_argument('--dns-share', type=float, default=0.1, help="由域名解析得到的IP比例")
+    parser.add_argument('--geo-mode', choices=('batch', 'single'), default='batch')
+    parser.add_argument('--geo-delay', type=float, default=0.0, help="假 ipinfo 每个请求的延迟（秒）")
+    parser.add_argument('--timeout', type=float, default=1)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--samples', type=int, default=3)
+    parser.add_argument('--download-count', type=int, default=20)
+    parser.add_argument('--download-bytes', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--processes', default='1',
+                        help="逗号分隔的进程数，detect 和 scan 阶段对每个进程数各跑一次并给出相对单进程的加速比")
+    parser.add_argument('--farm-processes', type=int, default=1, help="本地节点集群使用的进程数")
+    parser.add_argument('--json', help="把结果写成 JSON，便于跨版本对比")
+    parser.add_argument('--verbose', action='store_true', help="显示各阶段原有的打印输出")
+    args = parser.parse_args(argv)
+    args.processes = [int(value) for value in args.processes.split(',') if value.strip()]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cert_dir = tempfile.TemporaryDirectory(prefix="bench_cert_")
+    certfile = keyfile = None
+    if 'tls' in args.stages.split(','):
+        certfile, keyfile = make_test_certificate(cert_dir.name)
+    farm = ListenerFarm(args.latency, args.jitter, args.loss, args.bandwidth,
+                        processes=args.farm_processes, certfile=certfile, keyfile=keyfile).start()
+    geo = FakeGeoServer(args.geo_delay).start()
+    report = {'args': vars(args), 'python': sys.version.split()[0], 'scales': {}}
+    try:
+        for scale in (int(value) for value in args.scales.split(',') if value.strip()):
+            with tempfile.TemporaryDirectory(prefix=f"bench{scale}_") as workdir:
+                stages = add_speedup(run_scale(scale, args, farm, geo, workdir))
+            report['scales'][scale] = {'stages': stages}
+            if resource is not None:
+                report['scales'][scale]['max_rss_mb'] = round(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+            print_report(scale, stages)
+    finally:
+        farm.stop()
+        geo.stop()
+        cert_dir.cleanup()
+    report['geo_requests'] = geo.requests
+    report['farm_connections'] = farm.connections
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        print(f"\n结果已写入 {args.json}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import math
+import os
+import time
+
+from records import UNKNOWN, UNREACHABLE
+
+# 整次运行的时间预算（秒），0 表示不限制
+RUN_BUDGET = float(os.environ.get("RUN_BUDGET", "0"))
+# 预算中留给测速阶段的比例，探测和归属地查询必须在剩余部分内结束
+SPEED_TEST_SHARE = float(os.environ.get("SPEED_TEST_SHARE", "0.3"))
+# 上次握手延迟中位数低于该值（毫秒）的 IP 视为快速 IP，与上次允许的 IP 一起优先检测
+FAST_P50_MS = float(os.environ.get("FAST_P50_MS", "200"))
+
+
+class Deadline:
+    """全局截止时间。budget 为 None 或 0 时永不过期；reserve 切出一个提前结束的子截止时间，为后续阶段留出时间。"""
+
+    def __init__(self, budget=RUN_BUDGET, end=None):
+        if end is None and budget:
+            end = time.monotonic() + budget
+        self.end = end
+
+    def remaining(self):
+        if self.end is None:
+            return math.inf
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def cap(self, seconds):
+        """把一次等待限制在剩余时间内。"""
+        return min(seconds, self.remaining())
+
+    def reserve(self, seconds):
+        if self.end is None:
+            return Deadline(None)
+        return Deadline(None, end=self.end - seconds)
+
+    def __repr__(self):
+        return "Deadline(不限)" if self.end is None else f"Deadline(剩余 {self.remaining():.1f}s)"
+
+
+def priority_key(previous, latency=None, allowed=None, unreachable_since=None, fast_ms=FAST_P50_MS):
+    """待检测 IP 的排序键，按期望收益从高到低：
+
+    0. 上次属于允许国家或握手很快的 IP，按上次延迟从低到高；
+    1. 没有历史记录的新 IP；
+    2. 上次可达但被拦截或归属地未知的 IP；
+    3. 上次不可达的 IP，不可达越久越靠后。
+    """
+    latency = latency or {}
+    allowed = allowed or set()
+    unreachable_since = unreachable_since or {}
+
+    def key(ip):
+        entry = previous.get(ip)
+        stats = latency.get(ip)
+        p50 = stats.sort_key('p50') if stats else math.inf
+        if entry is None:
+            return (1, 0)
+        info = entry[0]
+        if info == UNREACHABLE:
+            return (3, -unreachable_since.get(ip, entry[1]))
+        if info in allowed or p50 <= fast_ms:
+            return (0, p50)
+        return (2, p50 if info != UNKNOWN else math.inf)
+    return key
+
+
+def prioritize(ips, previous, latency=None, allowed=None, unreachable_since=None, fast_ms=FAST_P50_MS):
+    return sorted(ips, key=priority_key(previous, latency, allowed, unreachable_since, fast_ms))
+
+
+def until_expired(items, deadline):
+    """逐个产出 items，截止时间一到就停止，供有界并发的探测池直接消费。"""
+    for item in items:
+        if deadline.expired():
+            return
+        yield item
@@ -0,0 +1,430 @@
+"""proxyip 的子命令入口。每个子命令只导入自己用到的模块，只重跑筛选或发布时不加载 dnspython 和测速器，
+也不访问网络（发布步骤的归属地优先走缓存）。
+
+    python cli.py run        # 完整流程，与 python DNS2Geo.py 相同
+    python cli.py collect    # 采集手动输入和域名解析的IP → ips_with_country/all_ips_with_country.txt
+    python cli.py detect     # 探测并查询归属地，更新上述文件并写出延迟表
+    python cli.py filter     # 按允许国家划分 → ips/、ips_with_country/ 和 CloudflareScanner/ip.txt
+    python cli.py scan       # 测速 → CloudflareScanner/result.csv
+    python cli.py publish    # 筛选测速结果并查询归属地 → proxyip.txt、proxyip_with_country.txt
+    python cli.py daemon     # 常驻复测并通过本地 HTTP 接口提供当前可用的 proxyip 列表
+
+设置 SHARD=i/N 时各子命令都读写 shards/i-of-N/ 下的文件，缓存也按分片隔离。
+"""
+import argparse
+import os
+import shutil
+import sys
+
+from records import OUTPUT_PATHS
+
+COUNTRIES_FILE = "countries.txt"
+ALLOWED_COUNTRIES_FILE = "allowed_countries.txt"
+MANUAL_IP_FILE = "Manual_input_IP.txt"
+DOMAINS_FILE = "domains.txt"
+# 测速目标：速度达标的IP总数 / 每个国家的达标数，0 表示不限制、全部测完
+SPEED_TARGET_COUNT = int(os.environ.get("SPEED_TARGET_COUNT", "0"))
+SPEED_TARGET_PER_COUNTRY = int(os.environ.get("SPEED_TARGET_PER_COUNTRY", "0"))
+# 最终列表中每个国家最多保留的IP数，0 表示不限制
+PROXYIP_PER_COUNTRY = int(os.environ.get("PROXYIP_PER_COUNTRY", "0"))
+
+
+class RunContext:
+    """由 SHARD 环境变量决定的输出目录、缓存目录和各结果文件路径。"""
+
+    def __init__(self, shard_value=None):
+        from sharding import parse_shard, shard_dir
+
+        self.shard = parse_shard(shard_value)
+        self.output_root = shard_dir(self.shard) if self.shard else ""
+        self.cache_dir = (os.path.join("cache", "shards", os.path.basename(self.output_root))
+                          if self.shard else "cache")
+        self.paths = {key: os.path.join(self.output_root, path) for key, path in OUTPUT_PATHS.items()}
+        self.scanner_dir = os.path.join(self.output_root, "CloudflareScanner")
+        self.ip_txt = os.path.join(self.scanner_dir, "ip.txt")
+        self.result_csv = os.path.join(self.scanner_dir, "result.csv")
+        self.probe_report = os.path.join(self.output_root, "ips_with_country/probe_report.csv")
+
+    def path(self, name):
+        return os.path.join(self.output_root, name)
+
+    def cache(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def makedirs(self):
+        os.makedirs(self.path("ips_with_country"), exist_ok=True)
+        os.makedirs(self.path("ips"), exist_ok=True)
+
+
+def _country_mapping():
+    from steps import load_country_mapping
+
+    country_mapping = load_country_mapping(COUNTRIES_FILE)
+    if not country_mapping:
+        print("未加载有效国家信息，程序退出。")
+    return country_mapping
+
+
+def _geo_provider(ctx, metrics=None, deadline=None):
+    """两处归属地查询共用同一份磁盘缓存；存在离线IP段库时优先离线查询，在线接口只处理未命中的IP。
+
+    返回 (provider, 缓存, 接口超时策略)，用完后由调用方关闭缓存、保存超时历史。
+    """
+    from geo_cache import GeoCache
+    from geo_offline import OFFLINE_GEO_DB, ONLINE_FALLBACK
+    from geo_provider import build_provider
+    from timeouts import AdaptiveTimeout, endpoint_key
+
+    geo_cache = GeoCache(ctx.cache("geo_cache.db"))
+    geo_timeouts = AdaptiveTimeout(ctx.cache("geo_rtt_history.json"), key_func=endpoint_key,
+                                   minimum=2, maximum=10)
+    provider = build_provider(geo_cache, offline_db=OFFLINE_GEO_DB, online_fallback=ONLINE_FALLBACK,
+                              timeout_policy=geo_timeouts, metrics=metrics, deadline=deadline)
+    return provider, geo_cache, geo_timeouts
+
+
+def _close_geo(geo_cache, geo_timeouts, metrics=None):
+    stats = geo_cache.stats()
+    print(f"归属地缓存: 命中 {stats['hits']} 次，未命中 {stats['misses']} 次")
+    geo_cache.close()
+    geo_timeouts.save()
+    if metrics is not None:
+        metrics.inc('geo_cache_hits_total', stats['hits'])
+        metrics.inc('geo_cache_misses_total', stats['misses'])
+
+
+def _probe_stages():
+    # 默认逐级探测 TCP → TLS → HTTP，提前淘汰不能作为代理使用的IP，PROBE_STAGES=tcp 时只测连通性
+    return tuple(s.strip() for s in os.environ.get("PROBE_STAGES", "tcp,tls,http").split(',') if s.strip())
+
+
+def cmd_collect(args, ctx):
+    from ip_state import IpStateStore
+    from steps import collect_all_ips
+
+    ctx.makedirs()
+    ip_state = IpStateStore(ctx.cache("ip_state.db"))
+    try:
+        ip_info = collect_all_ips(MANUAL_IP_FILE, DOMAINS_FILE, ctx.paths['all_with_info'], state=ip_state,
+                                  shard=ctx.shard)
+    finally:
+        ip_state.close()
+    print(f"采集完成，共 {len(ip_info)} 个IP")
+    return 0
+
+
+def cmd_detect(args, ctx):
+    from budget import RUN_BUDGET, Deadline
+    from ip_state import IpStateStore
+    from multiproc import PROBE_PROCESSES
+    from records import load_allowed_countries, write_partitioned_outputs
+    from steps import detect_all_ip_country
+    from timeouts import AdaptiveTimeout
+
+    country_mapping = _country_mapping()
+    if not country_mapping:
+        return 1
+    if not os.path.isfile(ctx.paths['all_with_info']):
+        print(f"未找到 {ctx.paths['all_with_info']}，请先运行 collect")
+        return 1
+    deadline = Deadline(RUN_BUDGET)
+    provider, geo_cache, geo_timeouts = _geo_provider(ctx, deadline=deadline)
+    tcp_timeouts = AdaptiveTimeout(ctx.cache("rtt_history.json"), minimum=0.3, maximum=5)
+    ip_state = IpStateStore(ctx.cache("ip_state.db"))
+    try:
+        records = detect_all_ip_country(ctx.paths['all_with_info'], None, country_mapping, provider=provider,
+                                        state=ip_state, stages=_probe_stages(), report_file=ctx.probe_report,
+                                        timeout_policy=tcp_timeouts, deadline=deadline,
+                                        allowed=load_allowed_countries(ALLOWED_COUNTRIES_FILE),
+                                        processes=PROBE_PROCESSES)
+    finally:
+        tcp_timeouts.save()
+        ip_state.close()
+        _close_geo(geo_cache, geo_timeouts)
+    write_partitioned_outputs(records, set(), {key: ctx.paths[key] for key in ('all_with_info', 'latency')})
+    print(f"所有IP归属地检测完成，已更新到 {ctx.paths['all_with_info']} 和 {ctx.paths['latency']}")
+    return 0
+
+
+def cmd_filter(args, ctx):
+    from steps import filter_ips_by_allowed_countries, save_ip_txt_for_cloudflarescanner
+
+    paths = ctx.paths
+    filter_ips_by_allowed_countries(
+        paths['all_with_info'], ALLOWED_COUNTRIES_FILE, paths['allowed_ips'], paths['blocked_ips'],
+        paths['allowed_with_info'], paths['blocked_with_info'],
+        paths['unreachable_ips'], paths['unreachable_with_info'],
+        latency_file=paths['latency'], max_p95=args.max_p95, max_loss=args.max_loss, sort_by=args.sort_by,
+        all_ip_file=paths['all_ips'],
+    )
+    save_ip_txt_for_cloudflarescanner(allowed_ip_file=paths['allowed_ips'], target_path=ctx.ip_txt)
+    return 0
+
+
+def _country_codes(records):
+    # 归属地信息为“国家代码+中文名”，测速目标按国家代码计数
+    return {record.address: record.country[:2] for record in records if record.country}
+
+
+def cmd_scan(args, ctx):
+    from pipeline import SpeedTargets
+    from records import read_records
+    from steps import run_cloudflarescanner_with_dn
+
+    countries = {}
+    if args.target_per_country and os.path.isfile(ctx.paths['allowed_with_info']):
+        countries = _country_codes(read_records(ctx.paths['allowed_with_info']))
+    targets = SpeedTargets(args.target_count, args.target_per_country, countries)
+    run_cloudflarescanner_with_dn(use_exe=args.exe, scanner_dir=ctx.scanner_dir, targets=targets,
+                                  min_speed=args.min_speed)
+    return 0
+
+
+def cmd_publish(args, ctx):
+    from records import read_latency_file
+    from speed_history import SpeedHistory
+    from steps import process_result_csv
+
+    provider, geo_cache, geo_timeouts = _geo_provider(ctx)
+    speed_history = SpeedHistory(ctx.cache("speed_history.db")) if args.order_by == 'score' else None
+    try:
+        process_result_csv(
+            input_file=ctx.result_csv,
+            proxyip_file=ctx.path('proxyip.txt'),
+            with_country_file=ctx.path('proxyip_with_country.txt'),
+            countries_file=COUNTRIES_FILE,
+            provider=provider,
+            order_by=args.order_by,
+            latency=read_latency_file(ctx.paths['latency']),
+            history=speed_history,
+            per_country=args.per_country,
+        )
+    finally:
+        if speed_history is not None:
+            speed_history.close()
+        _close_geo(geo_cache, geo_timeouts)
+    return 0
+
+
+def cmd_daemon(args, ctx):
+    import asyncio
+
+    from daemon import ListServer, ProxyDaemon
+    from ip_state import IpStateStore
+    from timeouts import AdaptiveTimeout
+
+    tcp_timeouts = AdaptiveTimeout(ctx.cache("rtt_history.json"), minimum=0.3, maximum=5)
+    ip_state = IpStateStore(ctx.cache("ip_state.db"))
+    daemon = ProxyDaemon(ctx.path('proxyip_with_country.txt'), ctx.paths['allowed_ips'], state=ip_state,
+                         timeout_policy=tcp_timeouts, interval=args.interval)
+    daemon.load()
+    server = ListServer(daemon.lists, args.host, args.port).start()
+    print(f"常驻模式已启动: http://{args.host}:{server.server_address[1]}/proxyip.txt")
+    try:
+        asyncio.run(daemon.run())
+    except KeyboardInterrupt:
+        print("收到中断，退出常驻模式")
+    finally:
+        server.stop()
+        tcp_timeouts.save()
+        ip_state.close()
+    return 0
+
+
+def cmd_run(args, ctx):
+    from budget import RUN_BUDGET, SPEED_TEST_SHARE, Deadline
+    from ip_state import IpStateStore
+    from metrics import Metrics
+    from multiproc import PROBE_PROCESSES
+    from pipeline import stream_speed_test
+    from records import load_allowed_countries, write_partitioned_outputs
+    from sharding import KEPT_FILE, write_kept
+    from speed_history import SpeedHistory
+    from steps import (
+        collect_all_ips, detect_all_ip_country, list_files, process_result_csv, run_cloudflarescanner_with_dn,
+        save_ip_txt_for_cloudflarescanner, wait_for_result_csv,
+    )
+    from timeouts import AdaptiveTimeout
+
+    # SHARD=i/N 时只处理第 i 个分片：结果写到 shards/i-of-N/，缓存也按分片隔离，最后用 sharding.py merge 合并
+    shard, output_root = ctx.shard, ctx.output_root
+    ctx.makedirs()
+
+    country_mapping = _country_mapping()
+    if not country_mapping:
+        return 1
+
+    # 设置 RUN_BUDGET 后整次运行有截止时间：探测与归属地查询为测速留出 SPEED_TEST_SHARE 的预算，
+    # 到点后停止派发新工作，用已有结果写出输出
+    deadline = Deadline(RUN_BUDGET)
+    detect_deadline = deadline.reserve(RUN_BUDGET * SPEED_TEST_SHARE)
+    # 各阶段耗时、计数和延迟直方图在运行结束时写到 metrics/run.json 与 metrics/proxyip.prom
+    metrics = Metrics()
+    # 握手与归属地接口的超时都按历史RTT自适应：握手按 /24 网段，接口按域名
+    tcp_timeouts = AdaptiveTimeout(ctx.cache("rtt_history.json"), minimum=0.3, maximum=5)
+    # 检测阶段的归属地重试同样不能占用留给测速的预算，进入测速阶段后再放宽到整次运行的截止时间
+    geo_deadline = Deadline(None, end=detect_deadline.end)
+    geo_provider, geo_cache, geo_timeouts = _geo_provider(ctx, metrics=metrics, deadline=geo_deadline)
+    ip_state = IpStateStore(ctx.cache("ip_state.db"))
+    # 跨运行的测速历史：按速度EWMA、波动和可达率评分，代替单次测速决定 proxyip 的去留
+    speed_history = SpeedHistory(ctx.cache("speed_history.db"))
+
+    output_paths = ctx.paths
+
+    # 各阶段在内存中传递记录，最后一次划分写出 ips/ 与 ips_with_country/ 下的全部文件
+    with metrics.stage('collect') as stage:
+        ip_info = collect_all_ips(MANUAL_IP_FILE, DOMAINS_FILE, None, state=ip_state, metrics=metrics,
+                                  shard=shard)
+        stage['items'] = len(ip_info)
+    allowed = load_allowed_countries(ALLOWED_COUNTRIES_FILE)
+    with metrics.stage('detect', len(ip_info)):
+        records = detect_all_ip_country(None, None, country_mapping, provider=geo_provider,
+                                        state=ip_state, ip_info=ip_info, stages=_probe_stages(),
+                                        report_file=ctx.probe_report,
+                                        timeout_policy=tcp_timeouts, metrics=metrics,
+                                        deadline=detect_deadline, allowed=allowed,
+                                        processes=PROBE_PROCESSES)
+    tcp_timeouts.save()
+    ip_state.close()
+    geo_deadline.end = deadline.end
+    # 允许的IP按握手延迟中位数排序，测速阶段优先测试延迟低的IP
+    with metrics.stage('partition', len(records)):
+        allowed_records, blocked_records, unreachable_records = write_partitioned_outputs(
+            records, allowed, output_paths, sort_by='p50')
+    print("筛选完成：")
+    print(f"✅ 允许: {len(allowed_records)} 个IP")
+    print(f"❌ 拦截: {len(blocked_records)} 个IP")
+    print(f"🚫 不可达: {len(unreachable_records)} 个IP")
+    save_ip_txt_for_cloudflarescanner(
+        allowed_ip_file=output_paths['allowed_ips'],
+        target_path=ctx.ip_txt
+    )
+
+    result_csv = ctx.result_csv
+    with metrics.stage('speed_test', len(allowed_records)):
+        if deadline.expired():
+            # 预算已用完时不覆盖上次的 proxyip.txt，保留现有的最佳结果
+            print("运行时间预算已用完，跳过测速，保留上次的 proxyip.txt")
+        elif not shard and os.name == 'nt' and os.path.isfile(os.path.join("CloudflareScanner", "CloudflareScanner.exe")):
+            # 运行exe前遍历目录
+            list_files("运行 exe 前")
+            run_cloudflarescanner_with_dn(use_exe=True)
+            # 运行exe后遍历目录
+            list_files("运行 exe 后")
+
+            if not wait_for_result_csv(result_csv, timeout=deadline.cap(600), interval=2):
+                return 1
+            process_result_csv(
+                input_file='CloudflareScanner/result.csv',
+                proxyip_file='proxyip.txt',
+                with_country_file='proxyip_with_country.txt',
+                countries_file=COUNTRIES_FILE,
+                RETRY=10,
+                provider=geo_provider,
+                order_by=os.environ.get("PROXYIP_ORDER_BY", "score"),
+                history=speed_history,
+                per_country=PROXYIP_PER_COUNTRY
+            )
+        else:
+            # 内置测速器：测速结果边产生边查询归属地并写出，总耗时约为测速与查询中较长的一方
+            kept = stream_speed_test(
+                ip_txt_path=ctx.ip_txt,
+                proxyip_file=ctx.path('proxyip.txt'),
+                with_country_file=ctx.path('proxyip_with_country.txt'),
+                country_dict=country_mapping,
+                provider=geo_provider,
+                min_speed=10,
+                result_csv_path=result_csv,
+                order_by=os.environ.get("PROXYIP_ORDER_BY", "score"),
+                latency={record.address: record.latency for record in records if record.latency},
+                deadline=deadline,
+                history=speed_history,
+                per_country=PROXYIP_PER_COUNTRY,
+                processes=PROBE_PROCESSES,
+                # 设置测速目标后按预测质量依次测速，达标IP数量够了就停止，节省测速流量和时间
+                target_count=SPEED_TARGET_COUNT,
+                target_per_country=SPEED_TARGET_PER_COUNTRY,
+                countries=_country_codes(allowed_records)
+            )
+            metrics.record('speed_test', 'success', len(kept))
+            metrics.record('speed_test', 'failure', len(allowed_records) - len(kept))
+            if shard:
+                # 合并时需要各分片入选IP的速度和评分，才能得到与单机运行相同的排序
+                write_kept(ctx.path(KEPT_FILE), kept, speed_history.scores([item[1] for item in kept]))
+    for country, top in sorted(speed_history.top_per_country(3).items()):
+        print(f"历史评分前列 {country}: " + ", ".join(f"{ip}({score:.1f})" for ip, score in top))
+    speed_history.close()
+    _close_geo(geo_cache, geo_timeouts, metrics)
+    json_path, prom_path = metrics.write(ctx.path("metrics"))
+    print(f"运行指标已写入 {json_path} 和 {prom_path}")
+    if args.backup_result:
+        # 删除 result.csv 前备份
+        backup_result_csv = os.path.join(ctx.scanner_dir, 'result_bak.csv')
+        try:
+            shutil.copyfile(result_csv, backup_result_csv)
+            print(f"已备份 {result_csv} 到 {backup_result_csv}")
+        except Exception as e:
+            print(f"备份 {result_csv} 时发生错误: {e}")
+    # 删除 result.csv
+    try:
+        os.remove(result_csv)
+        print(f"已删除 {result_csv}")
+    except Exception as e:
+        print(f"删除 {result_csv} 时发生错误: {e}")
+    return 0
+
+
+COMMANDS = {
+    'run': cmd_run,
+    'collect': cmd_collect,
+    'detect': cmd_detect,
+    'filter': cmd_filter,
+    'scan': cmd_scan,
+    'publish': cmd_publish,
+    'daemon': cmd_daemon,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="采集、检测、筛选 Cloudflare 反代IP并测速")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="依次完成全部步骤")
+    run.add_argument('--backup-result', action='store_true', help="删除测速结果前备份为 result_bak.csv")
+    commands.add_parser('collect', help="采集手动输入和域名解析得到的IP")
+    commands.add_parser('detect', help="探测握手延迟并查询归属地")
+    filter_ = commands.add_parser('filter', help="按允许国家和延迟阈值划分IP，生成测速输入")
+    filter_.add_argument('--max-p95', type=float, help="握手延迟 p95 上限（毫秒）")
+    filter_.add_argument('--max-loss', type=float, help="握手丢包率上限（0~1）")
+    filter_.add_argument('--sort-by', default='p50', help="测速输入的排序：ip/min/p50/p95/jitter/loss")
+    scan = commands.add_parser('scan', help="对 CloudflareScanner/ip.txt 测速")
+    scan.add_argument('--exe', action='store_true', default=None,
+                      help="使用 CloudflareScanner.exe，默认仅在 Windows 且存在时使用")
+    scan.add_argument('--target-count', type=int, default=SPEED_TARGET_COUNT,
+                      help="速度达标的IP达到该数量后停止测速（仅内置测速器），0 表示全部测完")
+    scan.add_argument('--target-per-country', type=int, default=SPEED_TARGET_PER_COUNTRY,
+                      help="每个国家速度达标的IP达到该数量后不再测该国家的其余IP")
+    scan.add_argument('--min-speed', type=float, default=10, help="达标的下载速度（MB/s）")
+    publish = commands.add_parser('publish', help="由测速结果生成 proxyip.txt 和 proxyip_with_country.txt")
+    publish.add_argument('--order-by', default=os.environ.get("PROXYIP_ORDER_BY", "score"))
+    publish.add_argument('--per-country', type=int, default=PROXYIP_PER_COUNTRY, help="每个国家最多输出的IP数，0 为不限")
+    daemon = commands.add_parser('daemon', help="常驻复测并通过本地 HTTP 接口提供 proxyip 列表")
+    daemon.add_argument('--host', default=os.environ.get("DAEMON_HOST", "127.0.0.1"))
+    daemon.add_argument('--port', type=int, default=int(os.environ.get("DAEMON_PORT", "8080")))
+    daemon.add_argument('--interval', type=float, default=float(os.environ.get("RECHECK_INTERVAL", "600")),
+                        help="每个IP的目标复测间隔（秒）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        ctx = RunContext(os.environ.get("SHARD"))
+    except ValueError as e:
+        print(e)
+        return 1
+    return COMMANDS[args.command](args, ctx) or 0
+
+
+if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding='utf-8')
+    sys.exit(main())
@@ -0,0 +1,341 @@
+"""常驻模式：IP 集合常驻内存，按“越久未检测、近期失败越多越先复测”的顺序持续握手复测，
+连续失败的 IP 立即从对外列表中摘除；当前可用的 proxyip 列表通过本地 HTTP 接口提供，可按国家筛选。
+
+    python cli.py daemon --port 8080
+    curl 'http://127.0.0.1:8080/proxyip.txt?country=HK,JP'
+    curl 'http://127.0.0.1:8080/proxyip_with_country.txt'
+    curl 'http://127.0.0.1:8080/status'
+
+响应体在复测结果改变在线集合时预先生成好，读请求只做一次字典查找；定时批量任务重写 proxyip_with_country.txt 后自动重新加载。
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from probe import DEFAULT_PORT, probe_latency
+from records import PENDING, UNKNOWN, UNREACHABLE, split_address
+
+DAEMON_HOST = os.environ.get("DAEMON_HOST", "127.0.0.1")
+DAEMON_PORT = int(os.environ.get("DAEMON_PORT", "8080"))
+# 每个 IP 的目标复测间隔（秒）
+RECHECK_INTERVAL = float(os.environ.get("RECHECK_INTERVAL", "600"))
+# 每次近期失败把复测提前的秒数，刚失败的 IP 很快再测一次以确认是否下线或已恢复
+FAILURE_BOOST = float(os.environ.get("FAILURE_BOOST", "300"))
+# 连续失败达到该次数的 IP 不再对外提供，复测成功一次即恢复
+EVICT_AFTER_FAILURES = int(os.environ.get("EVICT_AFTER_FAILURES", "2"))
+DAEMON_BATCH_SIZE = int(os.environ.get("DAEMON_BATCH_SIZE", "200"))
+
+# 列表行格式为 IP#速度(MB/s)国家代码国家中文名，未知国家的行没有两位大写代码
+_COUNTRY_CODE = re.compile(r"\(MB/s\)([A-Z]{2})")
+LIST_PATHS = {'/': 'ip', '/proxyip.txt': 'ip', '/proxyip_with_country.txt': 'line'}
+
+
+class DaemonEntry:
+    """常驻内存的单个 IP：ip 为列表中的条目（可能是 ip:端口），served 表示它在 proxyip 列表中，
+    line 为该列表中的原始行。"""
+
+    __slots__ = ('ip', 'host', 'port', 'info', 'checked_at', 'failures', 'latency', 'served', 'line', 'country')
+
+    def __init__(self, ip, info=PENDING, checked_at=0.0, latency=None):
+        self.ip = ip
+        self.host, self.port = split_address(ip)
+        self.info = info
+        self.checked_at = checked_at
+        self.failures = 0
+        self.latency = latency
+        self.served = False
+        self.line = None
+        self.country = ''
+
+    @property
+    def online(self):
+        return self.failures < EVICT_AFTER_FAILURES
+
+
+def parse_proxyip_line(line):
+    """返回 (ip, 国家代码, 归属地信息)，国家未知时代码为空。"""
+    ip, _, rest = line.partition('#')
+    match = _COUNTRY_CODE.search(rest)
+    info = rest.split('(MB/s)', 1)[1] if '(MB/s)' in rest else UNKNOWN
+    return ip.strip(), match.group(1) if match else '', info
+
+
+class ServedLists:
+    """预先编码好的响应体：{(格式, 国家代码): bytes}，国家代码为空表示全部。
+
+    更新时复制一份字典再整体替换，读线程无需加锁，总能看到某一时刻完整的列表。
+    """
+
+    def __init__(self):
+        self._bodies = {}
+        self.status = b'{}'
+
+    def get(self, kind, countries=''):
+        bodies = self._bodies
+        if not countries:
+            return bodies.get((kind, ''), b'')
+        return b''.join(bodies.get((kind, code), b'') for code in countries.upper().split(','))
+
+    def update(self, entries, countries=None):
+        """entries 为按 proxyip 列表顺序排列的条目；countries 为 None 时全部重建，否则只重建这些国家和总表。"""
+        online = [entry for entry in entries if entry.online]
+        bodies = {} if countries is None else dict(self._bodies)
+        by_country = {}
+        for entry in online:
+            if countries is None or entry.country in countries:
+                by_country.setdefault(entry.country, []).append(entry)
+        for code in (by_country.keys() if countries is None else countries):
+            group = by_country.get(code, [])
+            bodies[('ip', code)] = ''.join(f"{entry.ip}\n" for entry in group).encode()
+            bodies[('line', code)] = ''.join(f"{entry.line}\n" for entry in group).encode()
+        bodies[('ip', '')] = ''.join(f"{entry.ip}\n" for entry in online).encode()
+        bodies[('line', '')] = ''.join(f"{entry.line}\n" for entry in online).encode()
+        self._bodies = bodies
+
+
+class ProxyDaemon:
+    """持有内存中的 IP 集合、复测优先队列和对外列表。
+
+    优先级为 上次检测时间 - FAILURE_BOOST × 连续失败次数，数值越小越先复测；
+    优先级加上 RECHECK_INTERVAL 早于当前时间的 IP 才会被取出。失败次数只计到摘除前一次为止，
+    已摘除的 IP 按正常间隔复测，不会反复占用探测。
+    """
+
+    def __init__(self, proxyip_file, allowed_ip_file=None, state=None, timeout_policy=None,
+                 interval=RECHECK_INTERVAL, failure_boost=FAILURE_BOOST, batch_size=DAEMON_BATCH_SIZE,
+                 port=DEFAULT_PORT, samples=2, concurrency=200):
+        self.proxyip_file = proxyip_file
+        self.allowed_ip_file = allowed_ip_file
+        self.state = state
+        self.timeout_policy = timeout_policy
+        self.interval = interval
+        self.failure_boost = failure_boost
+        self.batch_size = batch_size
+        self.port = port
+        self.samples = samples
+        self.concurrency = concurrency
+        self.entries = {}
+        self.served = []
+        self.lists = ServedLists()
+        self._queue = []
+        self._seq = itertools.count()
+        self._mtimes = None
+        self.started_at = time.time()
+        self.probed = 0
+        self.evicted = 0
+        self.recovered = 0
+
+    def priority(self, entry):
+        return entry.checked_at - self.failure_boost * min(entry.failures, EVICT_AFTER_FAILURES - 1)
+
+    def _push(self, entry):
+        heapq.heappush(self._queue, (self.priority(entry), next(self._seq), entry))
+
+    def _file_mtimes(self):
+        return tuple(os.path.getmtime(path) if path and os.path.isfile(path) else None
+                     for path in (self.proxyip_file, self.allowed_ip_file))
+
+    def load(self):
+        """（重新）读取 proxyip 列表和允许列表，沿用已在内存中的检测结果，新出现的 IP 按历史状态排队。"""
+        self._mtimes = self._file_mtimes()
+        previous = self.state.load() if self.state is not None else {}
+        latency = self.state.load_latency() if self.state is not None else {}
+        lines = []
+        if os.path.isfile(self.proxyip_file):
+            with open(self.proxyip_file, 'r', encoding='utf-8') as f:
+                lines = [line.strip() for line in f if line.strip()]
+        allowed = []
+        if self.allowed_ip_file and os.path.isfile(self.allowed_ip_file):
+            with open(self.allowed_ip_file, 'r', encoding='utf-8') as f:
+                allowed = [line.strip() for line in f if line.strip()]
+
+        entries, served = {}, []
+
+        def entry_for(ip):
+            entry = entries.get(ip) or self.entries.get(ip)
+            if entry is None:
+                host = split_address(ip)[0]
+                info, checked_at = previous.get(host, (PENDING, 0.0))
+                entry = DaemonEntry(ip, info, checked_at, latency.get(host))
+                self._push(entry)
+            entry.served = False
+            entries[ip] = entry
+            return entry
+
+        for line in lines:
+            ip, country, info = parse_proxyip_line(line)
+            if ip in entries:
+                continue
+            entry = entry_for(ip)
+            entry.served, entry.line, entry.country = True, line, country
+            if entry.info in (PENDING, UNKNOWN):
+                entry.info = info
+            served.append(entry)
+        for ip in allowed:
+            if ip not in entries:
+                entry_for(ip)
+        # 从两个列表中消失的 IP 出队时被跳过
+        self.entries = entries
+        self.served = served
+        self.lists.update(self.served)
+        self._refresh_status()
+        print(f"已加载 {len(served)} 个代理IP，共 {len(entries)} 个IP参与复测")
+
+    def reload_if_changed(self):
+        if self._file_mtimes() != self._mtimes:
+            self.load()
+            return True
+        return False
+
+    def due(self, now=None):
+        """取出最多 batch_size 个到期的 IP。"""
+        now = now or time.time()
+        batch = []
+        while self._queue and len(batch) < self.batch_size:
+            priority, _, entry = self._queue[0]
+            if self.entries.get(entry.ip) is not entry:
+                heapq.heappop(self._queue)
+                continue
+            if priority + self.interval > now:
+                break
+            heapq.heappop(self._queue)
+            batch.append(entry)
+        return batch
+
+    def seconds_until_due(self, now=None):
+        if not self._queue:
+            return self.interval
+        return max(0.0, self._queue[0][0] + self.interval - (now or time.time()))
+
+    def apply(self, results, now=None):
+        """写回一批复测结果并重新排队，只在在线集合变化时重建受影响国家的响应体。"""
+        now = now or time.time()
+        changed = set()
+        updates = {}
+        for entry, stats in results:
+            was_online = entry.online
+            entry.checked_at = now
+            entry.latency = stats
+            if stats.reachable:
+                if entry.failures >= EVICT_AFTER_FAILURES and entry.served:
+                    self.recovered += 1
+                entry.failures = 0
+                if entry.info == UNREACHABLE:
+                    # 恢复可达的 IP 归属地需要重新查询，交给下次批量运行
+                    entry.info = PENDING
+            else:
+                entry.failures += 1
+                entry.info = UNREACHABLE
+                if entry.served and was_online and not entry.online:
+                    self.evicted += 1
+                    print(f"代理IP {entry.ip} 连续 {entry.failures} 次不可达，已从列表中摘除")
+            if entry.served and entry.online != was_online:
+                changed.add(entry.country)
+            updates[entry.host] = entry.info
+            self._push(entry)
+        self.probed += len(results)
+        if changed:
+            self.lists.update(self.served, changed)
+        self._refresh_status()
+        if self.state is not None and updates:
+            self.state.update(updates, checked_at=now,
+                              latency={entry.host: entry.latency for entry, _ in results})
+
+    def _refresh_status(self):
+        online = sum(1 for entry in self.served if entry.online)
+        self.lists.status = json.dumps({
+            'started_at': round(self.started_at, 3),
+            'ips': len(self.entries),
+            'served': len(self.served),
+            'online': online,
+            'queued': len(self._queue),
+            'probed': self.probed,
+            'evicted': self.evicted,
+            'recovered': self.recovered,
+            'next_due_seconds': round(self.seconds_until_due(), 1),
+        }, ensure_ascii=False).encode()
+
+    async def probe_once(self, now=None):
+        batch = self.due(now)
+        if not batch:
+            return 0
+        # 条目带端口时在该端口上复测，按端口分组并发进行
+        by_port = {}
+        for entry in batch:
+            by_port.setdefault(entry.port or self.port, {})[entry.host] = entry
+        groups = list(by_port.items())
+        results = await asyncio.gather(*(
+            probe_latency(list(group), samples=self.samples, port=port, concurrency=self.concurrency,
+                          timeout_policy=self.timeout_policy)
+            for port, group in groups
+        ))
+        self.apply([(group[host], stats) for (_, group), probed in zip(groups, results)
+                    for host, stats in probed.items()])
+        return len(batch)
+
+    async def run(self, stop=None, save_every=300):
+        """持续复测直到 stop（threading.Event）被设置。"""
+        stop = stop or threading.Event()
+        last_save = time.monotonic()
+        while not stop.is_set():
+            self.reload_if_changed()
+            if not await self.probe_once():
+                await asyncio.sleep(min(1.0, self.seconds_until_due()))
+            if self.timeout_policy is not None and time.monotonic() - last_save >= save_every:
+                self.timeout_policy.save()
+                last_save = time.monotonic()
+
+
+class _ListHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分两次写出，关闭 Nagle 避免与客户端的延迟确认相互等待
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        lists = self.server.lists
+        if url.path == '/status':
+            self._reply(lists.status, 'application/json')
+            return
+        kind = LIST_PATHS.get(url.path)
+        if kind is None:
+            self._reply(b'not found\n', status=404)
+            return
+        countries = parse_qs(url.query).get('country', [''])[0]
+        self._reply(lists.get(kind, countries))
+
+    def _reply(self, body, content_type='text/plain; charset=utf-8', status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ListServer(ThreadingHTTPServer):
+    """在后台线程中提供 ServedLists 的只读 HTTP 接口。"""
+
+    daemon_threads = True
+
+    def __init__(self, lists, host=DAEMON_HOST, port=DAEMON_PORT):
+        super().__init__((host, port), _ListHandler)
+        self.lists = lists
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.exception
+import dns.resolver
+
+DEFAULT_CACHE_FILE = os.path.join("cache", "dns_cache.json")
+DEFAULT_RECORD_TYPES = tuple(
+    t.strip().upper() for t in os.environ.get("DNS_RECORD_TYPES", "A").split(',') if t.strip()
+)
+
+
+class DnsHarvester:
+    """并发解析域名列表，所有线程共用一份解析器配置；解析结果按记录 TTL 缓存到磁盘，跨运行复用。"""
+
+    def __init__(self, nameservers=None, port=53, timeout=10, lifetime=15, workers=16,
+                 record_types=DEFAULT_RECORD_TYPES, cache_file=DEFAULT_CACHE_FILE):
+        self.resolver = dns.resolver.Resolver(configure=not nameservers)
+        if nameservers:
+            self.resolver.nameservers = list(nameservers)
+        self.resolver.port = port
+        self.resolver.timeout = timeout
+        self.resolver.lifetime = lifetime
+        self.resolver.cache = dns.resolver.Cache()
+        self.workers = workers
+        self.record_types = tuple(record_types)
+        self.cache_file = cache_file
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._cache = self._load_cache()
+
+    def _load_cache(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取DNS缓存 {self.cache_file} 失败: {e}")
+            return {}
+
+    def save_cache(self):
+        if not self.cache_file:
+            return
+        now = time.time()
+        with self._lock:
+            live = {key: entry for key, entry in self._cache.items() if entry['expires'] > now}
+        if os.path.dirname(self.cache_file):
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_path = f"{self.cache_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(live, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.cache_file)
+
+    def _resolve_type(self, domain, rdtype):
+        key = f"{domain}|{rdtype}"
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry and entry['expires'] > now:
+            return entry['ips'], True
+        try:
+            answer = self.resolver.resolve(domain, rdtype)
+        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+            # 没有该类型记录也是有效结果，按默认 5 分钟缓存
+            ips, ttl = [], 300
+        else:
+            ips = sorted({record.address for record in answer})
+            ttl = answer.rrset.ttl
+        with self._lock:
+            self._cache[key] = {'ips': ips, 'expires': now + ttl}
+        return ips, False
+
+    def resolve_domain(self, domain):
+        start = time.perf_counter()
+        ips = set()
+        cached = True
+        error = None
+        for rdtype in self.record_types:
+            try:
+                found, hit = self._resolve_type(domain, rdtype)
+                ips.update(found)
+                cached = cached and hit
+            except (dns.exception.DNSException, OSError) as e:
+                error = str(e)
+                cached = False
+        self.stats[domain] = {
+            'elapsed': round(time.perf_counter() - start, 3),
+            'ips': len(ips),
+            'cached': cached,
+            'error': error,
+        }
+        return ips
+
+    def resolve_all(self, domains):
+        """并发解析所有域名，返回合并后的 IP 集合，单个域名的耗时和错误记录在 self.stats。"""
+        all_ips = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for domain, ips in zip(domains, pool.map(self.resolve_domain, domains)):
+                stat = self.stats[domain]
+                if stat['error']:
+                    print(f"域名 {domain} 解析失败: {stat['error']}")
+                else:
+                    source = "缓存" if stat['cached'] else f"{stat['elapsed']}s"
+                    print(f"域名 {domain} 解析到 {stat['ips']} 个IP（{source}）")
+                all_ips.update(ips)
+        self.save_cache()
+        return all_ips
+
+    def summary(self):
+        failed = sum(1 for stat in self.stats.values() if stat['error'])
+        slowest = max(self.stats.items(), key=lambda item: item[1]['elapsed'], default=None)
+        return {'domains': len(self.stats), 'failed': failed, 'slowest': slowest}
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join("cache", "geo_cache.db")
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 100000
+
+
+class GeoCache:
+    """以 IP 为键的归属地磁盘缓存（SQLite），过期条目视为未命中，超出容量时淘汰最久未访问的条目。"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS geo ("
+            " ip TEXT PRIMARY KEY,"
+            " country TEXT NOT NULL,"
+            " fetched_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS geo_accessed ON geo (accessed_at)")
+        self._conn.commit()
+
+    def get(self, ip):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT country, fetched_at FROM geo WHERE ip = ?", (ip,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE geo SET accessed_at = ? WHERE ip = ?", (now, ip))
+            self.hits += 1
+            return row[0]
+
+    def get_many(self, ips):
+        """批量查询，只返回命中的 {ip: 国家代码}。"""
+        found = {}
+        for ip in ips:
+            country = self.get(ip)
+            if country is not None:
+                found[ip] = country
+        return found
+
+    def set(self, ip, country):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geo (ip, country, fetched_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (ip, country, now, now),
+            )
+            self._conn.commit()
+
+    def set_many(self, mapping):
+        for ip, country in mapping.items():
+            self.set(ip, country)
+
+    def evict(self):
+        """删除过期条目，再按最近访问时间淘汰超出容量的部分，返回删除条数。"""
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM geo WHERE fetched_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+            count = self._conn.execute("SELECT COUNT(*) FROM geo").fetchone()[0]
+            if count > self.max_entries:
+                removed += self._conn.execute(
+                    "DELETE FROM geo WHERE ip IN ("
+                    " SELECT ip FROM geo ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,),
+                ).rowcount
+            self._conn.commit()
+        return removed
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
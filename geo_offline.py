@@ -0,0 +1,147 @@
+import csv
+import ipaddress
+import os
+import socket
+from array import array
+from bisect import bisect_right
+
+from geo_provider import GeoProvider
+
+OFFLINE_GEO_DB = os.environ.get("GEO_OFFLINE_DB", os.path.join("geo", "ip_ranges.csv"))
+# 设为 0 时离线库未命中的 IP 不再在线查询
+ONLINE_FALLBACK = os.environ.get("GEO_ONLINE_FALLBACK", "1") != "0"
+
+
+class _RangeIndex:
+    """按起始地址排序的 [start, end] -> 国家 区间表，用二分查找定位。"""
+
+    def __init__(self, starts, ends, countries):
+        self.starts = starts
+        self.ends = ends
+        self.countries = countries
+
+    @classmethod
+    def build(cls, ranges, typecode):
+        ranges.sort()
+        starts = array(typecode) if typecode else []
+        ends = array(typecode) if typecode else []
+        countries = []
+        for start, end, country in ranges:
+            starts.append(start)
+            ends.append(end)
+            countries.append(country)
+        return cls(starts, ends, countries)
+
+    def lookup(self, value):
+        i = bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]:
+            return self.countries[i]
+        return None
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class OfflineGeoDatabase:
+    """本地 IP 段归属地库，支持 CSV（cidr,国家 或 起始IP,结束IP,国家）和 MMDB。"""
+
+    def __init__(self, v4_ranges, v6_ranges):
+        self.v4 = _RangeIndex.build(v4_ranges, 'I')
+        # IPv6 地址超出定长整数数组范围，使用普通列表
+        self.v6 = _RangeIndex.build(v6_ranges, None)
+
+    def __len__(self):
+        return len(self.v4) + len(self.v6)
+
+    @classmethod
+    def load(cls, path):
+        if path.lower().endswith('.mmdb'):
+            return cls.load_mmdb(path)
+        return cls.load_csv(path)
+
+    @classmethod
+    def load_csv(cls, path):
+        v4, v6 = [], []
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                row = [col.strip() for col in row]
+                if not row or row[0].startswith('#'):
+                    continue
+                try:
+                    if len(row) == 2:
+                        network = ipaddress.ip_network(row[0], strict=False)
+                        start, end = network.network_address, network.broadcast_address
+                    elif len(row) >= 3:
+                        start, end = ipaddress.ip_address(row[0]), ipaddress.ip_address(row[1])
+                    else:
+                        continue
+                except ValueError:
+                    # 表头或格式错误的行
+                    continue
+                country = row[-1].upper()
+                if not country:
+                    continue
+                target = v4 if start.version == 4 else v6
+                target.append((int(start), int(end), country))
+        return cls(v4, v6)
+
+    @classmethod
+    def load_mmdb(cls, path):
+        try:
+            import maxminddb
+        except ImportError:
+            raise RuntimeError("读取 MMDB 需要安装 maxminddb：pip install maxminddb")
+        v4, v6 = [], []
+        with maxminddb.open_database(path) as reader:
+            for network, record in reader:
+                country = _mmdb_country(record)
+                if not country:
+                    continue
+                target = v4 if network.version == 4 else v6
+                target.append((int(network.network_address), int(network.broadcast_address), country))
+        return cls(v4, v6)
+
+    def lookup(self, ip):
+        try:
+            # IPv4 走 inet_pton 快速路径，比 ipaddress 解析快一个数量级
+            return self.v4.lookup(int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big'))
+        except OSError:
+            pass
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        index = self.v4 if addr.version == 4 else self.v6
+        return index.lookup(int(addr))
+
+
+def _mmdb_country(record):
+    if not isinstance(record, dict):
+        return None
+    country = record.get('country')
+    if isinstance(country, dict):
+        return country.get('iso_code')
+    # ipinfo / db-ip lite 等库直接给出 country_code 或 country 字符串
+    return record.get('country_code') or country
+
+
+class OfflineGeoProvider(GeoProvider):
+    """先查本地库，未命中的 IP 才交给 fallback（在线查询），fallback 为 None 时只做离线查询。"""
+
+    def __init__(self, database, fallback=None):
+        self.database = database
+        self.fallback = fallback
+
+    def lookup_batch(self, ips):
+        result = {}
+        misses = []
+        for ip in ips:
+            country = self.database.lookup(ip)
+            if country is None:
+                misses.append(ip)
+            else:
+                result[ip] = country
+        if misses and self.fallback is not None:
+            print(f"离线库未命中 {len(misses)} 个IP，转为在线查询")
+            result.update(self.fallback.lookup_batch(misses))
+        return result
@@ -0,0 +1,125 @@
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from http_client import HttpClient
+
+IPINFO_BASE_URL = os.environ.get("IPINFO_BASE_URL", "https://ipinfo.io")
+IPINFO_TOKEN = os.environ.get("IPINFO_TOKEN")
+# ipinfo 的请求速率上限（次/秒），按账号配额调整
+IPINFO_RATE = float(os.environ.get("IPINFO_RATE", "10"))
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class GeoProvider(ABC):
+    """归属地查询接口：lookup_batch 接收一批 IP，返回 {ip: 国家代码}，查询失败的 IP 不出现在结果中。"""
+
+    @abstractmethod
+    def lookup_batch(self, ips):
+        ...
+
+    def lookup(self, ip):
+        return self.lookup_batch([ip]).get(ip)
+
+
+class IpinfoProvider(GeoProvider):
+    """ipinfo.io 查询。有 token 时走 /batch 批量接口，否则在共享客户端上并发发送单 IP 请求。"""
+
+    def __init__(self, base_url=IPINFO_BASE_URL, token=IPINFO_TOKEN, chunk_size=100,
+                 workers=16, timeout=10, retries=5, rate=IPINFO_RATE, client=None,
+                 timeout_policy=None, metrics=None, deadline=None):
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.client = client or HttpClient(rate=rate, burst=workers, pool_size=workers,
+                                           retries=retries, timeout=timeout,
+                                           timeout_policy=timeout_policy, metrics=metrics,
+                                           deadline=deadline)
+
+    def _get_one(self, ip):
+        params = {"token": self.token} if self.token else None
+        try:
+            resp = self.client.get(f"{self.base_url}/{ip}/json", params=params)
+            if resp.status_code != 200:
+                print(f"API响应异常: {resp.status_code}")
+                return None
+            data = resp.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"获取 {ip} 国家信息失败，错误：{e}")
+            return None
+        if 'country' not in data:
+            print(f"{ip} 未返回国家，响应内容：{data}")
+            return None
+        return data['country']
+
+    def _post_batch(self, ips):
+        try:
+            resp = self.client.post(
+                f"{self.base_url}/batch",
+                params={"token": self.token},
+                json=[f"{ip}/country" for ip in ips],
+            )
+            if resp.status_code != 200:
+                print(f"批量接口响应异常: {resp.status_code}")
+                return {}
+            data = resp.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"批量查询失败，错误：{e}")
+            return {}
+        result = {}
+        for key, value in data.items():
+            ip = key.rsplit('/', 1)[0]
+            if isinstance(value, str) and value.strip():
+                result[ip] = value.strip()
+        return result
+
+    def lookup_batch(self, ips):
+        ips = list(ips)
+        result = {}
+        if self.token:
+            for chunk in chunked(ips, self.chunk_size):
+                result.update(self._post_batch(chunk))
+            return result
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for ip, code in zip(ips, pool.map(self._get_one, ips)):
+                if code:
+                    result[ip] = code
+        return result
+
+
+class CachedGeoProvider(GeoProvider):
+    """先查 GeoCache，只把未命中的 IP 交给下层 provider，并回写结果。"""
+
+    def __init__(self, provider, cache):
+        self.provider = provider
+        self.cache = cache
+
+    def lookup_batch(self, ips):
+        ips = list(ips)
+        result = self.cache.get_many(ips)
+        missing = [ip for ip in ips if ip not in result]
+        if missing:
+            fetched = self.provider.lookup_batch(missing)
+            self.cache.set_many(fetched)
+            result.update(fetched)
+        return result
+
+
+def build_provider(cache=None, offline_db=None, online_fallback=True, **kwargs):
+    """组装查询链：离线库（若存在）-> 磁盘缓存 -> ipinfo。"""
+    provider = IpinfoProvider(**kwargs)
+    if cache is not None:
+        provider = CachedGeoProvider(provider, cache)
+    if offline_db and os.path.isfile(offline_db):
+        from geo_offline import OfflineGeoDatabase, OfflineGeoProvider
+        database = OfflineGeoDatabase.load(offline_db)
+        print(f"已加载离线归属地库 {offline_db}，共 {len(database)} 个IP段")
+        provider = OfflineGeoProvider(database, provider if online_fallback else None)
+    return provider
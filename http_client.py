@@ -0,0 +1,160 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """线程安全的令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个；pause 可让所有调用方一起暂停。"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def parse_retry_after(value):
+    """Retry-After 可以是秒数或 HTTP 日期，返回需要等待的秒数，无法解析时返回 None。"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    """共享的 HTTP 客户端：长连接池 + 令牌桶限速 + 带抖动的指数退避，429/5xx 时优先遵循 Retry-After。
+
+    Retry-After 超过 backoff_max（如接口配额用完）时不再重试，在服务端要求的时间内对同一接口的请求
+    直接返回这次的响应，不再发出。
+    """
+
+    def __init__(self, rate=None, burst=None, pool_size=16, retries=5, timeout=10,
+                 backoff_base=0.5, backoff_max=30, timeout_policy=None, metrics=None, deadline=None):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.retries = retries
+        self.timeout = timeout
+        # 给出时按接口学习响应时间来决定超时，timeout 只作为未显式指定时的兜底
+        self.timeout_policy = timeout_policy
+        self.metrics = metrics
+        # 给出时截止时间一到就不再重试，等待时间也不会超出截止时间
+        self.deadline = deadline
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_counts = {}
+        # {接口: (可以再次请求的时间, 拒绝时的响应)}
+        self._refused = {}
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def backoff(self, attempt):
+        # full jitter：在 [0, base * 2^attempt] 内随机，避免多个线程同时重试
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _count_retry(self, url):
+        endpoint = urlsplit(url).netloc
+        with self._lock:
+            self.retry_counts[endpoint] = self.retry_counts.get(endpoint, 0) + 1
+        if self.metrics is not None:
+            self.metrics.inc('http_retries_total', endpoint=endpoint)
+
+    def request(self, method, url, **kwargs):
+        """发送请求，失败时自动重试；返回最后一次收到的响应，若从未收到响应则抛出最后的异常。"""
+        adaptive = 'timeout' not in kwargs and self.timeout_policy is not None
+        if adaptive:
+            kwargs['timeout'] = self.timeout_policy.timeout_for(url)
+        else:
+            kwargs.setdefault('timeout', self.timeout)
+        endpoint = urlsplit(url).netloc
+        refused = self._refused.get(endpoint)
+        if refused is not None and time.monotonic() < refused[0]:
+            return refused[1]
+        response = None
+        error = None
+        for attempt in range(self.retries):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                error = e
+                delay = self.backoff(attempt)
+                if self.metrics is not None:
+                    self.metrics.observe_request(endpoint, error=True)
+                if adaptive and isinstance(e, requests.exceptions.Timeout):
+                    kwargs['timeout'] = self.timeout_policy.next_timeout(kwargs['timeout'])
+                print(f"请求 {url} 失败（第 {attempt+1} 次）：{e}")
+            else:
+                if adaptive:
+                    self.timeout_policy.observe(url, response.elapsed.total_seconds() * 1000)
+                if self.metrics is not None:
+                    self.metrics.observe_request(endpoint, response.elapsed.total_seconds())
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                delay = parse_retry_after(response.headers.get('Retry-After'))
+                if delay is not None and delay > self.backoff_max:
+                    print(f"请求 {url} 返回 {response.status_code}，服务端要求 {delay:.0f}s 后重试，"
+                          f"超过退避上限 {self.backoff_max}s，不再重试")
+                    with self._lock:
+                        self._refused[endpoint] = (time.monotonic() + delay, response)
+                    return response
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if response.status_code == 429:
+                    print(f"请求 {url} 被限流，{delay:.1f}s 后重试")
+                    if self.bucket is not None:
+                        # 限流是全局的，让所有线程一起暂停
+                        self.bucket.pause(delay)
+                else:
+                    print(f"请求 {url} 返回 {response.status_code}（第 {attempt+1} 次）")
+            if attempt + 1 < self.retries:
+                if self.deadline is not None and self.deadline.remaining() <= delay:
+                    print(f"请求 {url} 已到运行截止时间，不再重试")
+                    break
+                self._count_retry(url)
+                time.sleep(delay)
+        if response is not None:
+            return response
+        raise error
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
@@ -0,0 +1,250 @@
+import ipaddress
+import os
+import random
+import socket
+from array import array
+from bisect import bisect_left
+from itertools import chain, islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# 每个网段/区间的默认采样方式：all 全部展开，first 取前 N 个，random 随机 N 个，stride 等间隔 N 个
+SAMPLE_MODES = ('all', 'first', 'random', 'stride')
+SAMPLE_MODE = os.environ.get("IP_SAMPLE_MODE", "all")
+SAMPLE_SIZE = int(os.environ.get("IP_SAMPLE_SIZE", "0"))
+# 单行最多展开的地址数，超过时按等间隔抽样，避免误写的大网段撑爆内存
+EXPAND_LIMIT = int(os.environ.get("IP_EXPAND_LIMIT", str(1 << 20)))
+
+
+def _parse_sampling(tokens, mode, size):
+    """解析行尾的采样覆盖，如 random=16、stride=256、first=10、all。"""
+    for token in tokens:
+        name, _, value = token.partition('=')
+        name = name.lower()
+        if name not in SAMPLE_MODES:
+            raise ValueError(f"未知的采样方式 {token}")
+        mode = name
+        size = int(value) if value else 0
+    return mode, size
+
+
+def parse_line(line):
+    """把一行输入解析为 (version, start, end, tokens)；支持单个IP、CIDR 和 a-b 区间，空行和注释返回 None。
+
+    区间的结束地址可以只写最后一段，如 1.2.3.10-20。
+    """
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
+    target, *tokens = line.split()
+    if '/' in target:
+        network = ipaddress.ip_network(target, strict=False)
+        return network.version, int(network.network_address), int(network.broadcast_address), tokens
+    if '-' in target:
+        first, last = (part.strip() for part in target.split('-', 1))
+        start = ipaddress.ip_address(first)
+        if last.isdigit() and start.version == 4:
+            end = ipaddress.ip_address(first.rsplit('.', 1)[0] + '.' + last)
+        else:
+            end = ipaddress.ip_address(last)
+        if end.version != start.version or int(end) < int(start):
+            raise ValueError(f"无效的IP区间 {target}")
+        return start.version, int(start), int(end), tokens
+    address = ipaddress.ip_address(target)
+    return address.version, int(address), int(address), tokens
+
+
+def sample_range(start, end, mode='all', size=0, limit=EXPAND_LIMIT, rng=None):
+    """按采样方式返回 [start, end] 内选中的地址整数（range 或 list），不会物化整个区间。"""
+    count = end - start + 1
+    if mode == 'all' or size <= 0 or size >= count:
+        if count <= limit:
+            return range(start, end + 1)
+        mode, size = 'stride', limit
+    if mode == 'first':
+        return range(start, start + size)
+    if mode == 'stride':
+        return range(start, end + 1, count // size)[:size]
+    rng = rng or random
+    if count <= 1 << 62:
+        return sorted(rng.sample(range(start, end + 1), size))
+    # IPv6 大网段超出 range 的长度上限，逐个抽取直到凑够
+    chosen = set()
+    while len(chosen) < size:
+        chosen.add(rng.randrange(start, end + 1))
+    return sorted(chosen)
+
+
+def unique_sorted(values):
+    """对 IPv4 整数去重并升序排列，返回 array('I')；装有 numpy 时向量化处理。"""
+    if numpy is not None:
+        unique = numpy.unique(numpy.asarray(values, dtype=numpy.uint32))
+        result = array('I')
+        result.frombytes(unique.astype(numpy.dtype('=u%d' % result.itemsize)).tobytes())
+        return result
+    values = values if isinstance(values, array) else array('I', values)
+    if all(a <= b for a, b in zip(values, islice(values, 1, None))):
+        # 网段按顺序展开时已经有序，只需去掉相邻的重复值，不必建整数集合
+        return array('I', (b for a, b in zip(chain((-1,), values), values) if a != b))
+    return array('I', sorted(set(values)))
+
+
+class IpRangeSet:
+    """展开后的候选地址：IPv4 存为紧凑的 uint32 数组，IPv6 存为整数集合。"""
+
+    def __init__(self, mode=SAMPLE_MODE, size=SAMPLE_SIZE, limit=EXPAND_LIMIT, seed=None):
+        if mode not in SAMPLE_MODES:
+            raise ValueError(f"未知的采样方式 {mode}")
+        self.mode = mode
+        self.size = size
+        self.limit = limit
+        self.rng = random.Random(seed)
+        self.v4 = array('I')
+        self.v6 = set()
+        self.invalid = 0
+
+    def add_line(self, line):
+        try:
+            parsed = parse_line(line)
+            if parsed is None:
+                return
+            version, start, end, tokens = parsed
+            mode, size = _parse_sampling(tokens, self.mode, self.size)
+        except ValueError as e:
+            self.invalid += 1
+            print(f"忽略无效的输入行 {line.strip()}: {e}")
+            return
+        selected = sample_range(start, end, mode, size, self.limit, self.rng)
+        if version == 4:
+            self.v4.extend(selected)
+        else:
+            self.v6.update(selected)
+
+    def add_lines(self, lines):
+        for line in lines:
+            self.add_line(line)
+        return self
+
+    def add_ips(self, ips):
+        """并入域名解析得到的单个地址字符串。"""
+        for ip in ips:
+            try:
+                self.v4.append(int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big'))
+            except OSError:
+                try:
+                    self.v6.add(int(ipaddress.IPv6Address(ip)))
+                except ValueError:
+                    self.invalid += 1
+        return self
+
+    def compact(self):
+        self.v4 = unique_sorted(self.v4)
+        return self
+
+    def __len__(self):
+        return len(self.v4) + len(self.v6)
+
+    def __iter__(self):
+        """按数值顺序产出地址字符串：先 IPv4 后 IPv6。"""
+        self.compact()
+        pack = socket.inet_ntop
+        for value in self.v4:
+            yield pack(socket.AF_INET, value.to_bytes(4, 'big'))
+        for value in sorted(self.v6):
+            yield str(ipaddress.IPv6Address(value))
+
+
+class IpInfoMap:
+    """{ip: 信息} 的紧凑实现，用法同 dict：地址沿用 IpRangeSet 的有序 uint32 数组，信息存为 array('H') 中的下标，
+    每个 IPv4 只占 6 个字节。键和迭代仍是地址字符串，按数值顺序；只能修改已有地址的信息，不能增删地址。
+    """
+
+    def __init__(self, ranges, default):
+        ranges.compact()
+        self.v4 = ranges.v4
+        self.v6 = sorted(ranges.v6)
+        self.labels = [default]
+        self._codes = {default: 0}
+        self.infos = array('H', bytes(2 * len(self)))
+
+    def _index(self, ip):
+        try:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+            values, offset = self.v4, 0
+        except (OSError, TypeError):
+            try:
+                value = int(ipaddress.IPv6Address(ip))
+            except ValueError:
+                return None
+            values, offset = self.v6, len(self.v4)
+        i = bisect_left(values, value)
+        if i < len(values) and values[i] == value:
+            return offset + i
+        return None
+
+    def _code(self, info):
+        code = self._codes.get(info)
+        if code is None:
+            code = self._codes[info] = len(self.labels)
+            self.labels.append(info)
+        return code
+
+    def __len__(self):
+        return len(self.v4) + len(self.v6)
+
+    def __contains__(self, ip):
+        return self._index(ip) is not None
+
+    def __getitem__(self, ip):
+        i = self._index(ip)
+        if i is None:
+            raise KeyError(ip)
+        return self.labels[self.infos[i]]
+
+    def __setitem__(self, ip, info):
+        i = self._index(ip)
+        if i is None:
+            raise KeyError(f"{ip} 不在候选集中")
+        self.infos[i] = self._code(info)
+
+    def get(self, ip, default=None):
+        i = self._index(ip)
+        return default if i is None else self.labels[self.infos[i]]
+
+    def update(self, other):
+        for ip, info in other.items():
+            self[ip] = info
+
+    def __iter__(self):
+        pack = socket.inet_ntop
+        for value in self.v4:
+            yield pack(socket.AF_INET, value.to_bytes(4, 'big'))
+        for value in self.v6:
+            yield str(ipaddress.IPv6Address(value))
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        labels = self.labels
+        return (labels[code] for code in self.infos)
+
+    def items(self):
+        return zip(self, self.values())
+
+    def copy(self):
+        clone = object.__new__(IpInfoMap)
+        clone.v4, clone.v6 = self.v4, self.v6
+        clone.labels, clone._codes = list(self.labels), dict(self._codes)
+        clone.infos = array('H', self.infos)
+        return clone
+
+
+def load_ranges(path, **kwargs):
+    ranges = IpRangeSet(**kwargs)
+    with open(path, 'r', encoding='utf-8') as f:
+        ranges.add_lines(f)
+    return ranges
@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import threading
+import time
+
+from probe import LatencyStats
+from records import format_ports, parse_ports_field
+
+DEFAULT_STATE_PATH = os.path.join("cache", "ip_state.db")
+DEFAULT_STALE_AFTER = 24 * 3600
+# 不可达 IP 的隔离期：第 n 次连续不可达后隔离 QUARANTINE_BASE × 2^(n-1) 秒，最长 QUARANTINE_MAX 秒；
+# 不短于结果的有效期 stale_after，否则隔离反而比普通 IP 复测得更频繁
+QUARANTINE_BASE = float(os.environ.get("QUARANTINE_BASE", str(DEFAULT_STALE_AFTER)))
+QUARANTINE_MAX = float(os.environ.get("QUARANTINE_MAX", str(7 * 24 * 3600)))
+
+
+def quarantine_delay(failures, base=QUARANTINE_BASE, maximum=QUARANTINE_MAX):
+    """连续不可达 failures 次后到下次复测的间隔（秒）。"""
+    if failures <= 0:
+        return 0.0
+    return min(maximum, base * 2 ** min(failures - 1, 32))
+
+
+class IpStateStore:
+    """记录每个 IP 上一次的检测结果和检测时间，用于增量运行：只重新检测新增或过期的 IP。
+
+    不可达的 IP 同时记录连续不可达次数，隔离期按次数指数增长，期满前沿用“不可达”的结果不再探测。
+    """
+
+    def __init__(self, path=DEFAULT_STATE_PATH, stale_after=DEFAULT_STALE_AFTER):
+        self.path = path
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ip_state ("
+            " ip TEXT PRIMARY KEY,"
+            " info TEXT NOT NULL,"
+            " checked_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(ip_state)")}
+        for field in (*LatencyStats.FIELDS, 'unreachable_since'):
+            if field not in columns:
+                self._conn.execute(f"ALTER TABLE ip_state ADD COLUMN {field} REAL")
+        if 'failures' not in columns:
+            self._conn.execute("ALTER TABLE ip_state ADD COLUMN failures INTEGER NOT NULL DEFAULT 0")
+        # 多端口探测选出的端口和各端口延迟（同延迟 CSV 的 ports 列），沿用上次结果时据此还原 ip:端口
+        if 'port' not in columns:
+            self._conn.execute("ALTER TABLE ip_state ADD COLUMN port INTEGER")
+        if 'ports' not in columns:
+            self._conn.execute("ALTER TABLE ip_state ADD COLUMN ports TEXT")
+        self._conn.commit()
+
+    def load(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT ip, info, checked_at FROM ip_state").fetchall()
+        return {ip: (info, checked_at) for ip, info, checked_at in rows}
+
+    def load_latency(self):
+        fields = ', '.join(LatencyStats.FIELDS)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT ip, {fields}, port, ports FROM ip_state WHERE loss IS NOT NULL"
+            ).fetchall()
+        latency = {}
+        for ip, *values, port, ports in rows:
+            latency[ip] = LatencyStats(**dict(zip(LatencyStats.FIELDS, values)), port=port,
+                                       ports=parse_ports_field(ports))
+        return latency
+
+    def load_unreachable_since(self):
+        """返回 {ip: 连续不可达的起始时间}，只包含上次检测不可达的 IP。"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT ip, unreachable_since FROM ip_state WHERE unreachable_since IS NOT NULL"
+            ).fetchall()
+        return dict(rows)
+
+    def load_failures(self):
+        """返回 {ip: 连续不可达次数}，只包含正在隔离的 IP。"""
+        with self._lock:
+            rows = self._conn.execute("SELECT ip, failures FROM ip_state WHERE failures > 0").fetchall()
+        return dict(rows)
+
+    def is_fresh(self, info, checked_at, now=None, failures=0):
+        # “未知”说明上次查询失败，下次运行总是重试
+        if info in ("未检测", "未知"):
+            return False
+        age = (now or time.time()) - checked_at
+        if info == "不可达" and failures:
+            return age < max(self.stale_after, quarantine_delay(failures))
+        return age < self.stale_after
+
+    def diff(self, ip_info):
+        """对比本次采集的 IP 与上次状态，返回 (ip_info, 新增数, 过期数, 移除数)。
+
+        ip_info 为本次采集、全部标记为“未检测”的 {ip: 信息}（如 IpInfoMap），原地填入沿用的结果；
+        状态表逐行读取，不整表载入内存。隔离期未满的不可达 IP 沿用“不可达”，隔离期满的与过期 IP 一样保持未检测。
+        """
+        now = time.time()
+        known = stale = 0
+        removed = []
+        with self._lock:
+            for ip, info, checked_at, failures in self._conn.execute(
+                    "SELECT ip, info, checked_at, failures FROM ip_state"):
+                if ip not in ip_info:
+                    removed.append(ip)
+                    continue
+                known += 1
+                if self.is_fresh(info, checked_at, now, failures):
+                    ip_info[ip] = info
+                else:
+                    stale += 1
+        self.remove(removed)
+        return ip_info, len(ip_info) - known, stale, len(removed)
+
+    def update(self, ip_info, checked_at=None, latency=None):
+        """写入检测结果；latency 为 {ip: LatencyStats}，连同选出的端口与国家信息一起保存。
+
+        连续不可达的 IP 保留第一次不可达的时间并累加不可达次数，恢复可达后两者都清空。
+        """
+        checked_at = checked_at or time.time()
+        latency = latency or {}
+        rows = []
+        for ip, info in ip_info.items():
+            stats = latency.get(ip)
+            values = [getattr(stats, field) if stats else None for field in LatencyStats.FIELDS]
+            values += [stats.port, format_ports(stats.ports) or None] if stats else [None, None]
+            unreachable = info == "不可达"
+            rows.append((ip, info, checked_at, *values, checked_at if unreachable else None, int(unreachable)))
+        fields = ', '.join((*LatencyStats.FIELDS, 'port', 'ports'))
+        updates = ', '.join(f"{field} = excluded.{field}"
+                            for field in ('info', 'checked_at', *LatencyStats.FIELDS, 'port', 'ports'))
+        placeholders = ', '.join('?' * (7 + len(LatencyStats.FIELDS)))
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT INTO ip_state (ip, info, checked_at, {fields}, unreachable_since, failures) "
+                f"VALUES ({placeholders}) "
+                f"ON CONFLICT(ip) DO UPDATE SET {updates}, "
+                "unreachable_since = CASE WHEN excluded.unreachable_since IS NULL THEN NULL "
+                "ELSE COALESCE(ip_state.unreachable_since, excluded.unreachable_since) END, "
+                "failures = CASE WHEN excluded.failures = 0 THEN 0 ELSE ip_state.failures + 1 END",
+                rows,
+            )
+            self._conn.commit()
+
+    def remove(self, ips):
+        with self._lock:
+            self._conn.executemany("DELETE FROM ip_state WHERE ip = ?", [(ip,) for ip in ips])
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
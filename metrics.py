@@ -0,0 +1,204 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
+METRICS_PREFIX = "proxyip"
+TCP_CONNECT_BUCKETS_MS = (10, 25, 50, 100, 200, 400, 800, 1600, 3200)
+HTTP_BUCKETS_SECONDS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_RESULTS = ('success', 'failure', 'unreachable')
+
+
+class Histogram:
+    """累积直方图，桶上界与 Prometheus 的 le 含义一致。"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{value}"' for key, value in labels)
+    return '{' + pairs + '}'
+
+
+class Metrics:
+    """一次运行的指标：各阶段耗时、处理量和成功/失败/不可达计数，握手与 HTTP 请求的耗时直方图，各接口的重试次数。
+
+    线程安全，探测线程和归属地查询线程可直接写入；运行结束后用 write 导出 JSON 摘要和 Prometheus textfile。
+    """
+
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.started_at = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        with self._lock:
+            state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def merge(self, other):
+        """把另一个 Metrics（例如工作进程传回的）的计数和直方图累加进来。"""
+        with self._lock:
+            for name, entry in other.stages.items():
+                target = self._stage(name)
+                for key, value in entry.items():
+                    target[key] += value
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in other.histograms.items():
+                target = self.histograms.get(key)
+                if target is None:
+                    target = self.histograms[key] = Histogram(histogram.buckets)
+                target.counts = [a + b for a, b in zip(target.counts, histogram.counts)]
+                target.count += histogram.count
+                target.sum += histogram.sum
+
+    def _stage(self, name):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = {'seconds': 0.0, 'items': 0, **{key: 0 for key in STAGE_RESULTS}}
+        return entry
+
+    @contextmanager
+    def stage(self, name, items=0):
+        """计时一个阶段，可在 with 块内通过返回的字典补写 items。"""
+        with self._lock:
+            entry = self._stage(name)
+            entry['items'] += items
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                entry['seconds'] = round(entry['seconds'] + time.perf_counter() - start, 3)
+
+    def record(self, stage, result, count=1):
+        """记录阶段内单个条目的结果：success / failure / unreachable。"""
+        with self._lock:
+            self._stage(stage)[result] += count
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def observe_connect(self, rtt_ms):
+        """记录一次 TCP 握手，rtt_ms 为 None 表示失败。"""
+        if rtt_ms is None:
+            self.inc('tcp_connect_failures_total')
+        else:
+            self.observe('tcp_connect_ms', rtt_ms, TCP_CONNECT_BUCKETS_MS)
+
+    def observe_request(self, endpoint, seconds=None, error=False):
+        if error:
+            self.inc('http_request_errors_total', endpoint=endpoint)
+        else:
+            self.observe('http_request_seconds', seconds, HTTP_BUCKETS_SECONDS, endpoint=endpoint)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'started_at': round(self.started_at, 3),
+                'duration_seconds': round(time.time() - self.started_at, 3),
+                'stages': {name: dict(entry) for name, entry in self.stages.items()},
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                    for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])
+                ],
+            }
+
+    def prometheus_lines(self):
+        p = self.prefix
+        summary = self.to_dict()
+        lines = [
+            f"# TYPE {p}_last_run_timestamp_seconds gauge",
+            f"{p}_last_run_timestamp_seconds {summary['started_at']}",
+            f"# TYPE {p}_run_duration_seconds gauge",
+            f"{p}_run_duration_seconds {summary['duration_seconds']}",
+            f"# TYPE {p}_stage_duration_seconds gauge",
+        ]
+        for name, entry in summary['stages'].items():
+            lines.append(f'{p}_stage_duration_seconds{{stage="{name}"}} {entry["seconds"]}')
+        lines.append(f"# TYPE {p}_stage_items gauge")
+        for name, entry in summary['stages'].items():
+            lines.append(f'{p}_stage_items{{stage="{name}"}} {entry["items"]}')
+        lines.append(f"# TYPE {p}_stage_results gauge")
+        for name, entry in summary['stages'].items():
+            for result in STAGE_RESULTS:
+                lines.append(f'{p}_stage_results{{stage="{name}",result="{result}"}} {entry[result]}')
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {p}_{name} counter")
+            lines.append(f"{p}_{name}{_label_text(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {p}_{name} histogram")
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f"{p}_{name}_bucket{_label_text(labels + (('le', bound),))} {count}")
+            lines.append(f"{p}_{name}_bucket{_label_text(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{p}_{name}_sum{_label_text(labels)} {round(histogram.sum, 3)}")
+            lines.append(f"{p}_{name}_count{_label_text(labels)} {histogram.count}")
+        return lines
+
+    def write(self, directory=METRICS_DIR):
+        """写出 run.json 和 node_exporter textfile 格式的 proxyip.prom，返回两个路径。"""
+        os.makedirs(directory, exist_ok=True)
+        json_path = os.path.join(directory, "run.json")
+        prom_path = os.path.join(directory, f"{self.prefix}.prom")
+        for path, content in (
+            (json_path, json.dumps(self.to_dict(), ensure_ascii=False, indent=1)),
+            (prom_path, '\n'.join(self.prometheus_lines()) + '\n'),
+        ):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return json_path, prom_path
@@ -0,0 +1,135 @@
+import asyncio
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+from metrics import Metrics
+from probe import probe_latency
+from scanner import DOWNLOAD_CONCURRENCY, scan_ips
+from staged_probe import StageConfig, staged_probe
+
+# 探测和测速使用的进程数，1 表示在当前进程内完成
+PROBE_PROCESSES = int(os.environ.get("PROBE_PROCESSES", "1"))
+# 每批 IP 数的上限；IP 总数已知时按进程数均分，小于上限的集合也能分到每个进程
+PROBE_BATCH_SIZE = int(os.environ.get("PROBE_BATCH_SIZE", "2000"))
+
+# 每个工作进程各自持有一个事件循环和一份超时策略快照
+_loop = None
+_timeout_policy = None
+
+
+def _init_worker(timeout_policy=None):
+    global _loop, _timeout_policy
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    _timeout_policy = timeout_policy
+
+
+def _probe_batch(batch, mode, options, want_metrics):
+    metrics = Metrics() if want_metrics else None
+    if mode == 'staged':
+        config = StageConfig(**options, timeout_policy=_timeout_policy, metrics=metrics)
+        results = _loop.run_until_complete(staged_probe(batch, config))
+    else:
+        results = _loop.run_until_complete(probe_latency(
+            batch, on_result=None, timeout_policy=_timeout_policy, metrics=metrics, **options))
+    return list(results.items()), metrics
+
+
+def _scan_batch(batch, scan_kwargs, end=None):
+    # end 为墙钟截止时间，到点即放弃本批，父进程取消后已派出的批次也不会继续下载
+    timeout = None if end is None else max(0.0, end - time.time())
+    try:
+        return _loop.run_until_complete(asyncio.wait_for(scan_ips(batch, **scan_kwargs), timeout))
+    except asyncio.TimeoutError:
+        return []
+
+
+def _batch_size(total, processes, maximum=PROBE_BATCH_SIZE):
+    if not total:
+        return maximum
+    return max(1, min(maximum, -(-total // processes)))
+
+
+def _batches(ips, size):
+    ips = iter(ips)
+    while True:
+        batch = list(islice(ips, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_process_probe(ips, processes=PROBE_PROCESSES, batch_size=None, mode='latency',
+                       options=None, timeout_policy=None, metrics=None, total=None):
+    """把 IP 按批分给进程池探测，按批完成顺序产出 (ip, 结果)，接口与 iter_latency_probe / iter_staged_probe 相同。
+
+    mode 为 latency 时 options 是 probe_latency 的参数，为 staged 时是 StageConfig 的参数（ssl_context 除外，
+    由工作进程自行创建）。每个进程内的并发数沿用 options 中的 concurrency。
+    同时在途的批次不超过进程数的两倍，ips 可以是惰性迭代器（如受截止时间约束的 until_expired），
+    此时由 total 给出 IP 总数；未给出 batch_size 时按总数均分给各进程，每批不超过 PROBE_BATCH_SIZE。
+    工作进程拿到的是 timeout_policy 的快照，其观测结果按各 IP 的延迟中位数回馈给父进程的 policy；
+    各批次的 metrics 在父进程中合并。
+    """
+    options = options or {}
+    if batch_size is None:
+        if total is None and hasattr(ips, '__len__'):
+            total = len(ips)
+        batch_size = _batch_size(total, processes)
+    batches = _batches(ips, batch_size)
+    snapshot = timeout_policy.snapshot() if timeout_policy is not None else None
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(snapshot,)) as pool:
+        def submit(batch):
+            return pool.submit(_probe_batch, batch, mode, options, metrics is not None)
+
+        pending = {submit(batch) for batch in islice(batches, processes * 2)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results, batch_metrics = future.result()
+                if metrics is not None:
+                    metrics.merge(batch_metrics)
+                for ip, result in results:
+                    if timeout_policy is not None:
+                        stats = result.latency if mode == 'staged' else result
+                        if stats.p50 is not None:
+                            timeout_policy.observe(ip, stats.p50)
+                    yield ip, result
+                batch = next(batches, None)
+                if batch is not None:
+                    pending.add(submit(batch))
+
+
+async def scan_in_processes(ips, processes=PROBE_PROCESSES, batch_size=None, on_result=None, deadline=None,
+                            **scan_kwargs):
+    """多进程版 scan_ips：每个进程对一批 IP 完成延迟和下载测速，整批完成后逐行回调 on_result。
+
+    各批独立测速，因此只适用于对全部可用 IP 测下载速度（download_count 为 None）的情况。
+    下载共享同一出口带宽，download_concurrency 是所有进程合计的下载并发数，由各进程分摊，
+    测得的速度和达标判断不随进程数变化；进程数不超过下载并发数。
+    给出 deadline（budget.Deadline）时各工作进程到点自行停止测速，已在执行或排队的批次不会拖过截止时间。
+    """
+    ips = list(ips)
+    download_concurrency = scan_kwargs.pop('download_concurrency', DOWNLOAD_CONCURRENCY)
+    processes = max(1, min(processes, download_concurrency))
+    scan_kwargs['download_concurrency'] = max(1, download_concurrency // processes)
+    end = None if deadline is None or deadline.end is None else time.time() + deadline.remaining()
+    batch_size = batch_size or max(1, -(-len(ips) // (processes * 4)))
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker)
+    rows = []
+    try:
+        tasks = [asyncio.wrap_future(pool.submit(_scan_batch, batch, scan_kwargs, end), loop=loop)
+                 for batch in _batches(ips, batch_size)]
+        for task in asyncio.as_completed(tasks):
+            for row in await task:
+                rows.append(row)
+                if on_result is not None:
+                    on_result(row)
+    finally:
+        # 截止时间到达被取消时不等待未开始的批次
+        pool.shutdown(wait=False, cancel_futures=True)
+    rows.sort(key=lambda row: (-row['Download Speed (MB/s)'], row['Average Delay']))
+    return rows
@@ -0,0 +1,252 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from records import address_key, split_address, write_lines_atomic
+from multiproc import scan_in_processes
+from scanner import scan_ips, write_result_csv
+
+# 达标 IP 的归属地查询先攒一小段时间再整批提交，攒满 GEO_BATCH_SIZE 个时立即提交
+GEO_BATCH_WINDOW = float(os.environ.get("GEO_BATCH_WINDOW", "0.5"))
+GEO_BATCH_SIZE = int(os.environ.get("GEO_BATCH_SIZE", "100"))
+
+
+def format_proxyip_line(ip, speed, country_code, country_dict):
+    # 输出格式：IP#速度(MB/s)国家代码国家中文名
+    return f"{ip}#{speed:.2f}(MB/s){country_code}{country_dict.get(country_code, country_code)}"
+
+
+def proxyip_order_key(order_by='speed', latency=None, scores=None):
+    """最终 proxyip 列表的排序键：speed 按本次速度从高到低，score 按历史评分从高到低，
+    min/p50/p95/jitter/loss 按该延迟指标从低到高。"""
+    latency = latency or {}
+    if order_by == 'speed':
+        return lambda ip, speed: -speed
+    if order_by == 'score':
+        scores = scores or {}
+        return lambda ip, speed: (-scores.get(ip, speed), -speed)
+
+    def key(ip, speed):
+        stats = latency.get(ip) or latency.get(split_address(ip)[0])
+        return (stats.sort_key(order_by) if stats else float('inf'), -speed)
+    return key
+
+
+def predicted_rank(history=None, min_speed=10):
+    """下载测速顺序的排序键：历史评分达标的 IP 按评分从高到低，其次是没有历史的 IP，最后是历史评分不达标的；
+    同一档内按本次测得的延迟从低到高。没有历史时只按延迟排序。"""
+    def key(row):
+        delay = row['Average Delay']
+        stats = history.get(row['IP Address']) if history is not None else None
+        if stats is None:
+            return (1, 0.0, delay)
+        score = stats.score(history.penalty)
+        return (0 if score > min_speed else 2, -score, delay)
+    return key
+
+
+class SpeedTargets:
+    """测速目标：达标（超过速度阈值）的 IP 总数达到 count，或某个国家达标数达到 per_country 后，
+    不再对（该国家的）其余 IP 测下载。countries 为 {ip: 国家代码}，来自检测阶段的归属地。"""
+
+    def __init__(self, count=0, per_country=0, countries=None):
+        self.count = count
+        self.per_country = per_country
+        self.countries = countries or {}
+        self.qualified = {}
+
+    def __bool__(self):
+        return bool(self.count or self.per_country)
+
+    def country(self, ip):
+        return self.countries.get(split_address(ip)[0], '')
+
+    def add(self, ip):
+        code = self.country(ip)
+        self.qualified[code] = self.qualified.get(code, 0) + 1
+
+    def met(self, ip):
+        if self.count and sum(self.qualified.values()) >= self.count:
+            return True
+        return bool(self.per_country) and self.qualified.get(self.country(ip), 0) >= self.per_country
+
+    def skip(self, row):
+        return self.met(row['IP Address'])
+
+
+async def _stream(ips, proxyip_out, country_out, provider, country_dict, min_speed,
+                  geo_workers, scan_kwargs, deadline=None, history=None, processes=1, targets=None):
+    loop = asyncio.get_running_loop()
+    geo_pool = ThreadPoolExecutor(max_workers=geo_workers)
+    geo_tasks = []
+    kept = []
+    finished = []
+    skipped = set()
+
+    waiting = []
+    flush_timer = None
+
+    async def locate(batch):
+        # 条目可能是 ip:端口，归属地按 IP 查询
+        hosts = sorted({split_address(ip)[0] for ip, _ in batch})
+        codes = await loop.run_in_executor(geo_pool, provider.lookup_batch, hosts)
+        for ip, speed in batch:
+            country_code = codes.get(split_address(ip)[0], 'Unknown')
+            line = format_proxyip_line(ip, speed, country_code, country_dict)
+            country_out.write(f"{line}\n")
+            print(line)
+            kept.append((speed, ip, line, country_code))
+        country_out.flush()
+
+    def flush():
+        nonlocal flush_timer
+        if flush_timer is not None:
+            flush_timer.cancel()
+            flush_timer = None
+        if waiting:
+            geo_tasks.append(asyncio.ensure_future(locate(list(waiting))))
+            waiting.clear()
+
+    def on_result(row):
+        nonlocal flush_timer
+        finished.append(row)
+        speed = row['Download Speed (MB/s)']
+        ip = row['IP Address']
+        # 有历史时按计入本次结果后的评分筛选，一次偶然的快或慢不再直接决定去留
+        value = speed if history is None else history.preview(ip, speed, row['Average Delay'])
+        if value <= min_speed:
+            return
+        if targets:
+            targets.add(ip)
+        proxyip_out.write(f"{ip}\n")
+        proxyip_out.flush()
+        # 归属地查询与测速并行进行，短时间内达标的 IP 合并为一次批量查询
+        waiting.append((ip, speed))
+        if len(waiting) >= GEO_BATCH_SIZE:
+            flush()
+        elif flush_timer is None:
+            flush_timer = loop.call_later(GEO_BATCH_WINDOW, flush)
+
+    def skip(row):
+        if targets.skip(row):
+            skipped.add(row['IP Address'])
+            return True
+        return False
+
+    timeout = None if deadline is None or deadline.end is None else deadline.remaining()
+    complete = True
+    try:
+        try:
+            if processes > 1:
+                if targets:
+                    print("多进程测速不支持按目标数量提前结束，将测试全部IP")
+                scan = scan_in_processes(ips, processes, on_result=on_result, deadline=deadline, **scan_kwargs)
+            else:
+                scan = scan_ips(ips, on_result=on_result, rank=predicted_rank(history, min_speed),
+                                skip=skip if targets else None, **scan_kwargs)
+            rows = await asyncio.wait_for(scan, timeout)
+        except asyncio.TimeoutError:
+            complete = False
+            # 预算用完时停止测速，已测完的 IP 照常输出
+            print(f"测速已到运行截止时间，已完成 {len(finished)} 个IP的下载测速")
+            rows = sorted(finished, key=lambda row: -row['Download Speed (MB/s)'])
+        flush()
+        await asyncio.gather(*geo_tasks)
+    finally:
+        geo_pool.shutdown(wait=False)
+    return rows, kept, complete, skipped
+
+
+def speed_observations(ips, rows, complete=True, skipped=()):
+    """把测速结果整理为 SpeedHistory.record_run 的输入；完整测完时未出现在结果中的 IP 记为不可达。
+
+    skipped 为因达到目标而未测下载的 IP，它们不计入历史。"""
+    observations = {ip: (None, None) for ip in ips if ip not in skipped} if complete else {}
+    for row in rows:
+        observations[row['IP Address']] = (row['Download Speed (MB/s)'], row['Average Delay'])
+    return observations
+
+
+def limit_per_country(items, per_country, code_of):
+    """保持顺序，每个国家只保留前 per_country 个；per_country 为 0 时不限制。"""
+    if not per_country:
+        return items
+    counts = {}
+    limited = []
+    for item in items:
+        code = code_of(item)
+        counts[code] = counts.get(code, 0) + 1
+        if counts[code] <= per_country:
+            limited.append(item)
+    return limited
+
+
+def order_kept(kept, order_by='speed', latency=None, scores=None, per_country=0):
+    """对 (速度, ip, 输出行, 国家代码) 列表排序并按国家限量；同分时按 IP 数值排序，保证分片合并与单机结果一致。"""
+    key = proxyip_order_key(order_by, latency, scores)
+    kept = sorted(kept, key=lambda item: (key(item[1], item[0]), address_key(item[1])))
+    return limit_per_country(kept, per_country, lambda item: item[3])
+
+
+def stream_speed_test(
+    ip_txt_path='CloudflareScanner/ip.txt',
+    proxyip_file='proxyip.txt',
+    with_country_file='proxyip_with_country.txt',
+    country_dict=None,
+    provider=None,
+    min_speed=10,
+    result_csv_path='CloudflareScanner/result.csv',
+    geo_workers=8,
+    order_by='speed',
+    latency=None,
+    deadline=None,
+    history=None,
+    per_country=0,
+    processes=1,
+    target_count=0,
+    target_per_country=0,
+    countries=None,
+    **scan_kwargs
+):
+    """测速、归属地查询和结果输出流水线：每个 IP 测速完成后立即追加到 proxyip.txt.partial 并提交归属地查询，
+    结束时按 order_by 写出两个输出文件，并写出 result.csv 供排查。本次没有达标 IP 时保留上次的输出文件。
+    两个 .partial 进度文件在正常结束后删除，异常中断时保留已测出的达标 IP。
+
+    给出 deadline 时到点即停止测速，用已完成的结果写出输出文件。
+    给出 history（SpeedHistory）时按 EWMA 评分而不是单次速度筛选，并把本次结果写入历史；
+    per_country 限制每个国家最多输出的 IP 数；processes 大于 1 时分批在多个进程中测速。
+    target_count / target_per_country 为达标 IP 的目标数（总数 / 每个国家，国家取自 countries），
+    下载测速按预测质量从高到低进行，目标达成后不再测其余 IP。"""
+    with open(ip_txt_path, 'r', encoding='utf-8') as f:
+        ips = [line.strip() for line in f if line.strip()]
+    scan_kwargs.setdefault('download_count', len(ips))
+    country_dict = country_dict or {}
+
+    # 边测边写的是进度文件，上次的输出在本次有结果之前保持不变；运行中或异常中断后可查看 .partial 了解进度
+    partial_files = (f"{proxyip_file}.partial", f"{with_country_file}.partial")
+    with open(partial_files[0], 'w', encoding='utf-8') as proxyip_out, \
+            open(partial_files[1], 'w', encoding='utf-8') as country_out:
+        targets = SpeedTargets(target_count, target_per_country, countries)
+        rows, kept, complete, skipped = asyncio.run(_stream(
+            ips, proxyip_out, country_out, provider, country_dict, min_speed,
+            geo_workers, scan_kwargs, deadline, history, processes, targets,
+        ))
+
+    scores = None
+    if history is not None:
+        countries = {ip: code for _, ip, _, code in kept if code != 'Unknown'}
+        scores = history.record_run(
+            speed_observations(ips, rows, complete, skipped), countries)
+    kept = order_kept(kept, order_by, latency, scores, per_country)
+    if result_csv_path:
+        write_result_csv(rows, result_csv_path)
+    if not kept and os.path.isfile(proxyip_file):
+        print(f"本次没有达标的IP，保留上次的 {proxyip_file} 和 {with_country_file}")
+    else:
+        write_lines_atomic(proxyip_file, [item[1] for item in kept])
+        write_lines_atomic(with_country_file, [item[2] for item in kept])
+        print(f"筛选完成，共输出 {len(kept)} 个IP到 {proxyip_file} 和 {with_country_file}")
+    # 正常结束后进度已体现在输出文件中
+    for path in partial_files:
+        os.remove(path)
+    return kept
@@ -0,0 +1,215 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+DEFAULT_PORT = 443
+DEFAULT_TIMEOUT = 5
+DEFAULT_CONCURRENCY = 200
+# Cloudflare 代理接受 HTTPS 的全部端口
+CLOUDFLARE_HTTPS_PORTS = (443, 2053, 2083, 2087, 2096, 8443)
+
+
+def parse_ports(value):
+    """解析逗号分隔的端口列表，all 表示 Cloudflare 全部 HTTPS 端口。"""
+    if value.strip().lower() == 'all':
+        return CLOUDFLARE_HTTPS_PORTS
+    return tuple(dict.fromkeys(int(port) for port in value.split(',') if port.strip()))
+
+
+# 探测的端口，默认只探测 443；多个端口时同一 IP 的各端口并发探测
+PROBE_PORTS = parse_ports(os.environ.get("PROBE_PORTS", str(DEFAULT_PORT)))
+# 多端口探测时所有 IP 和端口共用的同时连接数上限
+PROBE_MAX_CONNECTIONS = int(os.environ.get("PROBE_MAX_CONNECTIONS", "1000"))
+
+_DONE = object()
+
+
+class LatencyStats:
+    """多次握手采样的延迟统计，单位毫秒；全部失败时各项延迟为 None，loss 为 1。
+
+    port 为探测到的端口（多端口探测时为延迟最低的端口），多端口探测时 ports 为 {可达端口: 延迟中位数}。
+    """
+
+    __slots__ = ('samples', 'min', 'p50', 'p95', 'jitter', 'loss', 'port', 'ports')
+    FIELDS = ('min', 'p50', 'p95', 'jitter', 'loss')
+
+    def __init__(self, samples=0, min=None, p50=None, p95=None, jitter=None, loss=1.0, port=None, ports=None):
+        self.samples = samples
+        self.min = min
+        self.p50 = p50
+        self.p95 = p95
+        self.jitter = jitter
+        self.loss = loss
+        self.port = port
+        self.ports = ports
+
+    @classmethod
+    def from_samples(cls, rtts, attempts):
+        if not rtts:
+            return cls(samples=attempts)
+        ordered = sorted(rtts)
+        # 抖动取相邻两次采样差值的平均
+        diffs = [abs(b - a) for a, b in zip(rtts, rtts[1:])]
+        return cls(
+            samples=attempts,
+            min=round(ordered[0], 2),
+            p50=round(percentile(ordered, 50), 2),
+            p95=round(percentile(ordered, 95), 2),
+            jitter=round(sum(diffs) / len(diffs), 2) if diffs else 0.0,
+            loss=round(1 - len(rtts) / attempts, 3),
+        )
+
+    @property
+    def reachable(self):
+        return self.loss < 1
+
+    def sort_key(self, field='p50'):
+        value = getattr(self, field)
+        return float('inf') if value is None else value
+
+    def __repr__(self):
+        return f"LatencyStats(p50={self.p50}, p95={self.p95}, jitter={self.jitter}, loss={self.loss})"
+
+
+def percentile(ordered, pct):
+    """对已排序的样本做线性插值取百分位。"""
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+async def measure_connect(ip, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT):
+    """完成一次 TCP 握手，返回耗时毫秒，失败返回 None。"""
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (asyncio.TimeoutError, OSError):
+        return None
+    rtt = (time.perf_counter() - start) * 1000
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return rtt
+
+
+async def probe_latency_one(ip, samples=3, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT, interval=0.05,
+                            timeout_policy=None, metrics=None):
+    """依次握手 samples 次并统计延迟。给出 timeout_policy 时超时由其按 IP 所在分组决定，
+    成功的样本回馈给 policy，超时后下一次尝试放宽超时；给出 metrics 时每次握手计入直方图。"""
+    if timeout_policy is not None:
+        timeout = timeout_policy.timeout_for(ip)
+    rtts = []
+    for i in range(samples):
+        start = time.perf_counter()
+        rtt = await measure_connect(ip, port, timeout)
+        if metrics is not None:
+            metrics.observe_connect(rtt)
+        if rtt is not None:
+            rtts.append(rtt)
+            if timeout_policy is not None:
+                timeout_policy.observe(ip, rtt)
+        elif timeout_policy is not None and time.perf_counter() - start >= timeout:
+            timeout = timeout_policy.next_timeout(timeout)
+        if interval and i + 1 < samples:
+            await asyncio.sleep(interval)
+    return LatencyStats.from_samples(rtts, samples)
+
+
+async def probe_ports_one(ip, ports, samples=3, timeout=DEFAULT_TIMEOUT, interval=0.05,
+                          timeout_policy=None, metrics=None, budget=None):
+    """并发探测同一 IP 的多个端口，返回延迟最低端口的 LatencyStats（记录各可达端口的延迟）。
+
+    budget 为所有 IP 共用的 asyncio.Semaphore，限制同时打开的连接数。
+    """
+    async def one(port):
+        async with budget or nullcontext():
+            return port, await probe_latency_one(ip, samples, port, timeout, interval, timeout_policy, metrics)
+
+    results = await asyncio.gather(*(one(port) for port in ports))
+    reachable = {port: stats for port, stats in results if stats.reachable}
+    if not reachable:
+        return LatencyStats(samples=samples)
+    port, best = min(reachable.items(), key=lambda item: (item[1].sort_key('p50'), item[0]))
+    best.port = port
+    best.ports = {port: stats.p50 for port, stats in sorted(reachable.items())}
+    return best
+
+
+def latency_prober(samples=3, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT, timeout_policy=None, metrics=None,
+                   ports=None, concurrency=DEFAULT_CONCURRENCY):
+    """返回单个 IP 的延迟探测协程函数：ports 多于一个时各端口并发探测，否则只探测 port。"""
+    if not ports or len(ports) == 1:
+        port = ports[0] if ports else port
+
+        async def probe_one(ip):
+            stats = await probe_latency_one(ip, samples, port, timeout, timeout_policy=timeout_policy,
+                                            metrics=metrics)
+            if stats.reachable:
+                stats.port = port
+            return stats
+        return probe_one
+    # 每个 IP 的端口并发进行，总连接数不超过 IP 并发数 × 端口数，也不超过 PROBE_MAX_CONNECTIONS
+    budget = asyncio.Semaphore(min(PROBE_MAX_CONNECTIONS, concurrency * len(ports)))
+    return lambda ip: probe_ports_one(ip, ports, samples, timeout, timeout_policy=timeout_policy,
+                                      metrics=metrics, budget=budget)
+
+
+async def _run_bounded(ips, probe, concurrency, on_result=None):
+    results = {}
+    pending = iter(ips)
+
+    async def worker():
+        for ip in pending:
+            result = await probe(ip)
+            results[ip] = result
+            if on_result is not None:
+                on_result(ip, result)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    await asyncio.gather(*workers)
+    return results
+
+
+async def probe_latency(ips, samples=3, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT,
+                        concurrency=DEFAULT_CONCURRENCY, on_result=None, timeout_policy=None, metrics=None,
+                        ports=None):
+    """每个 IP 依次握手 samples 次，多个 IP 并发进行，返回 {ip: LatencyStats}；给出多个 ports 时见 probe_ports_one。"""
+    probe = latency_prober(samples, port, timeout, timeout_policy, metrics, ports, concurrency)
+    return await _run_bounded(ips, probe, concurrency, on_result)
+
+
+def iter_in_background(run_probe):
+    """在后台线程的事件循环中运行 run_probe(on_result)，在当前线程按完成顺序产出 (ip, 结果)。"""
+    results = queue.Queue()
+
+    def run():
+        try:
+            asyncio.run(run_probe(lambda ip, result: results.put((ip, result))))
+        finally:
+            results.put(_DONE)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while True:
+        item = results.get()
+        if item is _DONE:
+            break
+        yield item
+    thread.join()
+
+
+def iter_latency_probe(ips, samples=3, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT,
+                       concurrency=DEFAULT_CONCURRENCY, timeout_policy=None, metrics=None, ports=None):
+    """在后台线程中运行延迟探测，按完成顺序逐个产出 (ip, LatencyStats)，便于后续阶段边探测边处理。"""
+    return iter_in_background(
+        lambda on_result: probe_latency(ips, samples, port, timeout, concurrency, on_result,
+                                        timeout_policy, metrics, ports)
+    )
@@ -0,0 +1,271 @@
+import csv
+import ipaddress
+import os
+import socket
+
+# IPv6 地址整数加上该标记，保证与 IPv4 不冲突且数值排序时排在所有 IPv4 之后
+V6_FLAG = 1 << 128
+
+PENDING = "未检测"
+UNREACHABLE = "不可达"
+UNKNOWN = "未知"
+# 输出中省略的默认端口，其他端口写成 ip:端口
+DEFAULT_HTTPS_PORT = 443
+
+
+def ip_to_int(ip):
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except OSError:
+        return int(ipaddress.IPv6Address(ip)) | V6_FLAG
+
+
+def int_to_ip(value):
+    if value & V6_FLAG:
+        return str(ipaddress.IPv6Address(value ^ V6_FLAG))
+    return socket.inet_ntop(socket.AF_INET, value.to_bytes(4, 'big'))
+
+
+def split_address(entry):
+    """把 ip、ip:端口 或 [IPv6]:端口 拆成 (ip, 端口)，没有端口时端口为 None。"""
+    if entry.startswith('['):
+        host, _, port = entry[1:].partition(']')
+        return host, int(port[1:]) if port.startswith(':') else None
+    if entry.count(':') == 1:
+        host, port = entry.split(':')
+        return host, int(port)
+    return entry, None
+
+
+def join_address(ip, port=None, default_port=DEFAULT_HTTPS_PORT):
+    """split_address 的逆操作，默认端口不写出。"""
+    if port is None or port == default_port:
+        return ip
+    return f"[{ip}]:{port}" if ':' in ip else f"{ip}:{port}"
+
+
+def address_key(entry):
+    """ip:端口 形式条目的排序键：先按 IP 数值，再按端口。"""
+    ip, port = split_address(entry)
+    return ip_to_int(ip), port or DEFAULT_HTTPS_PORT
+
+
+class IPRecord:
+    """阶段之间在内存中传递的单个 IP 记录。
+
+    reachable: None 表示未检测；country 为“国家代码+中文名”或“未知”；latency 为 LatencyStats。
+    """
+
+    __slots__ = ('ip', 'country', 'reachable', 'latency')
+
+    def __init__(self, ip, country=None, reachable=None, latency=None):
+        self.ip = ip if isinstance(ip, int) else ip_to_int(ip)
+        self.country = country
+        self.reachable = reachable
+        self.latency = latency
+
+    @classmethod
+    def from_info(cls, ip, info):
+        if info == PENDING:
+            return cls(ip)
+        if info == UNREACHABLE:
+            return cls(ip, reachable=False)
+        return cls(ip, country=info, reachable=True)
+
+    @property
+    def address(self):
+        return int_to_ip(self.ip)
+
+    @property
+    def endpoint(self):
+        """带端口的地址：多端口探测选出的端口不是 443 时为 ip:端口。"""
+        return join_address(self.address, self.latency.port if self.latency else None)
+
+    @property
+    def info(self):
+        if self.reachable is None:
+            return PENDING
+        if not self.reachable:
+            return UNREACHABLE
+        return self.country or UNKNOWN
+
+    def __repr__(self):
+        return f"IPRecord({self.address}#{self.info})"
+
+
+def records_from_info(ip_info, latency=None):
+    records = [IPRecord.from_info(ip, info) for ip, info in ip_info.items()]
+    if latency:
+        for record in records:
+            record.latency = latency.get(record.address)
+    return records
+
+
+def read_records(path):
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.strip().split('#')
+            if len(parts) == 2:
+                records.append(IPRecord.from_info(parts[0], parts[1]))
+    return records
+
+
+LATENCY_FIELDS = ['ip', 'country', 'min_ms', 'p50_ms', 'p95_ms', 'jitter_ms', 'loss', 'port', 'ports']
+
+
+def format_ports(ports):
+    # {端口: 延迟中位数} 写成 443:12.5|8443:20.1
+    return '|'.join(f"{port}:{p50}" for port, p50 in sorted(ports.items())) if ports else ''
+
+
+def parse_ports_field(value):
+    ports = {}
+    for item in (value or '').split('|'):
+        if item:
+            port, _, p50 = item.partition(':')
+            ports[int(port)] = float(p50) if p50 not in ('', 'None') else None
+    return ports or None
+
+
+def read_latency_file(path):
+    latency = {}
+    if not path or not os.path.isfile(path):
+        return latency
+    # probe 依赖 asyncio 和 ssl，只在确实要读延迟表时导入，只做筛选的命令启动更快
+    from probe import LatencyStats
+
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            values = {}
+            for field in LatencyStats.FIELDS:
+                raw = row.get(field if field == 'loss' else f"{field}_ms", '')
+                values[field] = float(raw) if raw not in ('', None) else None
+            if values['loss'] is None:
+                values['loss'] = 1.0
+            # 旧版延迟表没有端口列
+            values['port'] = int(row['port']) if row.get('port') else None
+            values['ports'] = parse_ports_field(row.get('ports'))
+            latency[row['ip']] = LatencyStats(**values)
+    return latency
+
+
+def write_latency_file(path, records):
+    """把延迟统计和国家信息写在同一张 CSV 里，便于按延迟排查。"""
+    from probe import LatencyStats
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(LATENCY_FIELDS)
+        for record in records:
+            stats = record.latency
+            if stats is None:
+                continue
+            writer.writerow([record.address, record.info] + [
+                '' if getattr(stats, field) is None else getattr(stats, field)
+                for field in LatencyStats.FIELDS
+            ] + ['' if stats.port is None else stats.port, format_ports(stats.ports)])
+    os.replace(tmp_path, path)
+
+
+def write_lines_atomic(path, lines):
+    """先写临时文件再改名，避免中途失败留下写了一半的结果文件。"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(f"{line}\n")
+    os.replace(tmp_path, path)
+
+
+def load_allowed_countries(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return {line.strip().replace(" ", "") for line in f if line.strip()}
+
+
+def passes_latency(record, max_p95=None, max_loss=None):
+    stats = record.latency
+    if stats is None:
+        return True
+    if max_loss is not None and stats.loss > max_loss:
+        return False
+    if max_p95 is not None and (stats.p95 is None or stats.p95 > max_p95):
+        return False
+    return True
+
+
+def record_sort_key(sort_by='ip'):
+    """sort_by 为 ip 时按 IP 数值排序，为 min/p50/p95/jitter/loss 时按该延迟指标排序。"""
+    if sort_by == 'ip':
+        return lambda r: r.ip
+    return lambda r: (r.latency.sort_key(sort_by) if r.latency else float('inf'), r.ip)
+
+
+def partition_records(records, allowed, max_p95=None, max_loss=None):
+    """一次遍历把记录分为 允许 / 拦截 / 不可达 三组（不可达同时计入拦截），组内保持输入顺序。
+
+    国家允许但延迟或丢包超过阈值的 IP 计入拦截。
+    """
+    allowed_records, blocked, unreachable = [], [], []
+    for record in records:
+        info = record.info
+        if info in allowed and passes_latency(record, max_p95, max_loss):
+            allowed_records.append(record)
+        else:
+            blocked.append(record)
+            if info == UNREACHABLE:
+                unreachable.append(record)
+    return allowed_records, blocked, unreachable
+
+
+def _with_info_lines(records):
+    # 带国家信息的文件按国家分组，组内按 IP 数值排序
+    return [f"{r.address}#{r.info}" for r in sorted(records, key=lambda r: (r.info, r.ip))]
+
+
+# 主流程写出的全部结果文件，分片运行时整体放到分片目录下
+OUTPUT_PATHS = {
+    'all_ips': "ips/all_ips.txt",
+    'all_with_info': "ips_with_country/all_ips_with_country.txt",
+    'allowed_ips': "ips/allowed_ips.txt",
+    'allowed_with_info': "ips_with_country/allowed_ips_with_country.txt",
+    'blocked_ips': "ips/blocked_ips.txt",
+    'blocked_with_info': "ips_with_country/blocked_ips_with_country.txt",
+    'unreachable_ips': "ips/unreachable_ips.txt",
+    'unreachable_with_info': "ips_with_country/unreachable_ips_with_country.txt",
+    'latency': "ips_with_country/all_ips_latency.csv",
+}
+
+
+def write_partitioned_outputs(records, allowed, paths, max_p95=None, max_loss=None, sort_by='ip'):
+    """按 paths 中给出的文件一次性写出所有 ips/ 与 ips_with_country/ 结果，返回三组记录。
+
+    paths 可包含 all_ips、all_with_info、allowed_ips、allowed_with_info、blocked_ips、
+    blocked_with_info、unreachable_ips、unreachable_with_info、latency，缺少的键不写。
+    sort_by 决定允许列表（即测速输入）的顺序，其余文件按 IP 数值排序。
+    ips/ 下的纯 IP 列表中，多端口探测选出的端口不是 443 的 IP 写成 ip:端口；带国家信息的文件只写 IP。
+    """
+    records = sorted(records, key=lambda r: r.ip)
+    allowed_records, blocked, unreachable = partition_records(records, allowed, max_p95, max_loss)
+    if sort_by != 'ip':
+        allowed_records.sort(key=record_sort_key(sort_by))
+    groups = {
+        'all': records,
+        'allowed': allowed_records,
+        'blocked': blocked,
+        'unreachable': unreachable,
+    }
+    for name, group in groups.items():
+        ip_path = paths.get('all_ips' if name == 'all' else f"{name}_ips")
+        if ip_path:
+            write_lines_atomic(ip_path, [r.endpoint for r in group])
+        info_path = paths.get(f"{name}_with_info")
+        if info_path:
+            write_lines_atomic(info_path, _with_info_lines(group))
+    if paths.get('latency'):
+        write_latency_file(paths['latency'], records)
+    return allowed_records, blocked, unreachable
@@ -0,0 +1,181 @@
+import asyncio
+import csv
+import os
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from records import split_address
+
+SPEED_TEST_URL = os.environ.get("SPEED_TEST_URL", "https://speed.cloudflare.com/__down?bytes=200000000")
+# 同时进行的下载测速数，下载共享同一出口带宽，多进程测速时由各进程分摊
+DOWNLOAD_CONCURRENCY = 4
+RESULT_FIELDS = ['IP Address', 'Sent', 'Received', 'Packet Loss', 'Average Delay', 'Download Speed (MB/s)']
+
+
+class ScanTarget:
+    """从测速地址解析出 Host/SNI、端口和路径，连接时直接连到待测 IP；ip:端口 形式的条目连到该端口。"""
+
+    def __init__(self, url=SPEED_TEST_URL):
+        parts = urlsplit(url)
+        self.use_tls = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.use_tls else 80)
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.ssl_context = None
+        if self.use_tls:
+            self.ssl_context = ssl.create_default_context()
+
+    async def connect(self, ip, timeout):
+        ip, port = split_address(ip)
+        return await asyncio.wait_for(
+            asyncio.open_connection(
+                ip, port or self.port, ssl=self.ssl_context,
+                server_hostname=self.host if self.use_tls else None,
+            ),
+            timeout,
+        )
+
+
+async def _close(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (OSError, ssl.SSLError):
+        pass
+
+
+async def measure_latency(ip, target, samples=4, timeout=2):
+    """建立 samples 次 TCP（HTTPS 时含 TLS 握手）连接，返回 (成功次数, 平均延迟毫秒)。"""
+    delays = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        try:
+            _, writer = await target.connect(ip, timeout)
+        except (asyncio.TimeoutError, OSError, ssl.SSLError):
+            continue
+        delays.append((time.perf_counter() - start) * 1000)
+        await _close(writer)
+    if not delays:
+        return 0, None
+    return len(delays), sum(delays) / len(delays)
+
+
+async def measure_download(ip, target, duration=10, timeout=5, chunk_size=64 * 1024):
+    """下载测速地址最多 duration 秒，返回速度 MB/s，失败返回 0。"""
+    try:
+        reader, writer = await target.connect(ip, timeout)
+    except (asyncio.TimeoutError, OSError, ssl.SSLError):
+        return 0.0
+    try:
+        request = (
+            f"GET {target.path} HTTP/1.1\r\n"
+            f"Host: {target.host}\r\n"
+            "User-Agent: Mozilla/5.0\r\n"
+            "Accept: */*\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(request.encode())
+        await writer.drain()
+        header = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        status = header.split(b"\r\n", 1)[0].split()
+        if len(status) < 2 or status[1] != b"200":
+            return 0.0
+        received = 0
+        start = time.perf_counter()
+        deadline = start + duration
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                chunk = await asyncio.wait_for(reader.read(chunk_size), min(remaining, timeout))
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            received += len(chunk)
+        elapsed = time.perf_counter() - start
+        if elapsed <= 0:
+            return 0.0
+        return received / elapsed / 1024 / 1024
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            OSError, ssl.SSLError):
+        return 0.0
+    finally:
+        await _close(writer)
+
+
+async def scan_ips(ips, url=SPEED_TEST_URL, download_count=None, latency_samples=4,
+                   latency_timeout=2, latency_concurrency=200, download_concurrency=DOWNLOAD_CONCURRENCY,
+                   download_duration=10, download_timeout=5, on_result=None, rank=None, skip=None):
+    """先并发测延迟，再按延迟从低到高对前 download_count 个 IP 测下载速度，返回结果行列表。
+
+    on_result 在每个 IP 测速完成时立即以结果行调用，供下游边测边处理。
+    rank 为结果行的排序键时按它代替延迟决定下载测速的顺序；skip(结果行) 返回 True 的 IP 不再测下载，
+    用于达到目标数量后提前结束；跳过的 IP 不出现在返回结果中，不会以 0 速度写入 result.csv 或测速历史。
+    """
+    target = ScanTarget(url)
+    latency_sem = asyncio.Semaphore(latency_concurrency)
+
+    async def ping(ip):
+        async with latency_sem:
+            received, delay = await measure_latency(ip, target, latency_samples, latency_timeout)
+        return {
+            'IP Address': ip,
+            'Sent': latency_samples,
+            'Received': received,
+            'Packet Loss': round(1 - received / latency_samples, 2),
+            'Average Delay': round(delay, 2) if delay is not None else None,
+            'Download Speed (MB/s)': 0.0,
+        }
+
+    rows = await asyncio.gather(*(ping(ip) for ip in ips))
+    alive = sorted((row for row in rows if row['Received']), key=rank or (lambda row: row['Average Delay']))
+    print(f"延迟测试完成：{len(alive)}/{len(rows)} 个IP可用")
+    if download_count is not None:
+        alive = alive[:download_count]
+    pending = iter(alive)
+    skipped = set()
+
+    async def download_worker():
+        # 按顺序领取下一个 IP，领取时再判断是否跳过，目标达成后剩余的 IP 都不再下载
+        for row in pending:
+            if skip is not None and skip(row):
+                skipped.add(row['IP Address'])
+                continue
+            speed = await measure_download(row['IP Address'], target, download_duration, download_timeout)
+            row['Download Speed (MB/s)'] = round(speed, 2)
+            print(f"{row['IP Address']} 延迟 {row['Average Delay']}ms 下载速度 {row['Download Speed (MB/s)']} MB/s")
+            if on_result is not None:
+                on_result(row)
+
+    await asyncio.gather(*(download_worker() for _ in range(max(1, download_concurrency))))
+    if skipped:
+        print(f"已达到测速目标，跳过 {len(skipped)} 个IP的下载测速")
+    results = [row for row in rows if row['Received'] and row['IP Address'] not in skipped]
+    results.sort(key=lambda row: (-row['Download Speed (MB/s)'], row['Average Delay']))
+    return results
+
+
+def write_result_csv(rows, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def run_native_scanner(ip_txt_path, result_csv_path, download_count=None, **kwargs):
+    """跨平台替代 CloudflareScanner.exe：读取 ip.txt，测速后写出同样列名的 result.csv。"""
+    with open(ip_txt_path, 'r', encoding='utf-8') as f:
+        ips = [line.strip() for line in f if line.strip()]
+    rows = asyncio.run(scan_ips(ips, download_count=download_count, **kwargs))
+    write_result_csv(rows, result_csv_path)
+    print(f"测速完成，结果已写入 {result_csv_path}")
+    return rows
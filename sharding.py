@@ -0,0 +1,165 @@
+"""按 IP 哈希把候选集稳定地切成 N 个分片，各分片可在不同机器或矩阵任务上独立探测、查询归属地和测速，
+最后用 merge 合并为与单机运行相同的 ips/、ips_with_country/ 和 proxyip*.txt。
+
+    SHARD=0/4 python DNS2Geo.py      # 每个分片各跑一次，结果写到 shards/0-of-4/
+    python sharding.py merge         # 收齐 shards/ 下的全部分片后合并
+"""
+import argparse
+import csv
+import os
+import re
+import sys
+import zlib
+
+from records import (
+    OUTPUT_PATHS, ip_to_int, load_allowed_countries, read_latency_file, read_records,
+    write_lines_atomic, write_partitioned_outputs,
+)
+
+SHARD_ROOT = "shards"
+KEPT_FILE = "proxyip_kept.csv"
+KEPT_FIELDS = ['ip', 'speed', 'country', 'score', 'line']
+PROBE_REPORT = "ips_with_country/probe_report.csv"
+_SHARD_DIR = re.compile(r"^(\d+)-of-(\d+)$")
+
+
+def parse_shard(value):
+    """解析 "i/N" 形式的分片编号，空值返回 None。"""
+    if not value:
+        return None
+    index, _, count = value.partition('/')
+    index, count = int(index), int(count)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"无效的分片 {value}，应为 i/N 且 0 <= i < N")
+    return index, count
+
+
+def shard_of(ip, count):
+    # crc32 与进程和 Python 版本无关，同一 IP 每次都落在同一分片
+    return zlib.crc32(ip.encode()) % count
+
+
+def in_shard(ips, shard):
+    if shard is None:
+        return ips
+    index, count = shard
+    return (ip for ip in ips if shard_of(ip, count) == index)
+
+
+def shard_dir(shard, root=SHARD_ROOT):
+    index, count = shard
+    return os.path.join(root, f"{index}-of-{count}")
+
+
+def write_kept(path, kept, scores=None):
+    """保存分片的测速入选结果和评分，合并时据此重新排序。"""
+    scores = scores or {}
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(KEPT_FIELDS)
+        for speed, ip, line, code in kept:
+            writer.writerow([ip, speed, code, scores.get(ip, ''), line])
+    os.replace(tmp_path, path)
+
+
+def read_kept(path):
+    kept, scores = [], {}
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            kept.append((float(row['speed']), row['ip'], row['line'], row['country']))
+            if row['score'] != '':
+                scores[row['ip']] = float(row['score'])
+    return kept, scores
+
+
+def find_shards(root=SHARD_ROOT):
+    """找出 root 下的分片目录，分片数不一致或有缺失时报错。"""
+    found = {}
+    for name in sorted(os.listdir(root)):
+        match = _SHARD_DIR.match(name)
+        if match:
+            found[(int(match.group(1)), int(match.group(2)))] = os.path.join(root, name)
+    counts = {count for _, count in found}
+    if len(counts) != 1:
+        raise ValueError(f"{root} 下的分片数不一致或没有分片: {sorted(found)}")
+    count = counts.pop()
+    missing = [index for index in range(count) if (index, count) not in found]
+    if missing:
+        raise ValueError(f"缺少分片 {missing}（共 {count} 个）")
+    return [found[(index, count)] for index in range(count)]
+
+
+def merge_shards(dirs, allowed_countries_file="allowed_countries.txt", output_root="",
+                 order_by='score', per_country=0):
+    """合并各分片的检测结果和测速入选结果，按单机运行相同的规则写出全部输出文件。"""
+    from pipeline import order_kept
+
+    records, kept, scores, report_rows = [], [], {}, []
+    report_header = None
+    for directory in dirs:
+        shard_records = read_records(os.path.join(directory, OUTPUT_PATHS['all_with_info']))
+        latency = read_latency_file(os.path.join(directory, OUTPUT_PATHS['latency']))
+        for record in shard_records:
+            record.latency = latency.get(record.address)
+        records.extend(shard_records)
+        kept_path = os.path.join(directory, KEPT_FILE)
+        if os.path.isfile(kept_path):
+            shard_kept, shard_scores = read_kept(kept_path)
+            kept.extend(shard_kept)
+            scores.update(shard_scores)
+        report_path = os.path.join(directory, PROBE_REPORT)
+        if os.path.isfile(report_path):
+            with open(report_path, 'r', encoding='utf-8', newline='') as f:
+                reader = csv.reader(f)
+                report_header = next(reader, None)
+                report_rows.extend(reader)
+        print(f"已读取分片 {directory}: {len(shard_records)} 个IP")
+
+    paths = {key: os.path.join(output_root, path) for key, path in OUTPUT_PATHS.items()}
+    allowed_records, blocked, unreachable = write_partitioned_outputs(
+        records, load_allowed_countries(allowed_countries_file), paths, sort_by='p50')
+    write_lines_atomic(os.path.join(output_root, "CloudflareScanner/ip.txt"),
+                       [record.endpoint for record in allowed_records])
+    if report_header:
+        report_rows.sort(key=lambda row: ip_to_int(row[0]))
+        report_path = os.path.join(output_root, PROBE_REPORT)
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+        with open(report_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(report_header)
+            writer.writerows(report_rows)
+
+    latency = {record.address: record.latency for record in records if record.latency}
+    kept = order_kept(kept, order_by, latency, scores, per_country)
+    write_lines_atomic(os.path.join(output_root, "proxyip.txt"), [item[1] for item in kept])
+    write_lines_atomic(os.path.join(output_root, "proxyip_with_country.txt"), [item[2] for item in kept])
+    print(f"合并完成：{len(dirs)} 个分片，共 {len(records)} 个IP，允许 {len(allowed_records)} 个，"
+          f"拦截 {len(blocked)} 个，不可达 {len(unreachable)} 个，输出代理 {len(kept)} 个")
+    return kept
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合并分片运行的结果")
+    commands = parser.add_subparsers(dest='command', required=True)
+    merge = commands.add_parser('merge', help="把 shards/ 下的全部分片合并为最终输出")
+    merge.add_argument('--root', default=SHARD_ROOT, help="分片结果所在目录")
+    merge.add_argument('--allowed', default="allowed_countries.txt")
+    merge.add_argument('--output', default="", help="输出根目录，默认为当前目录")
+    merge.add_argument('--order-by', default=os.environ.get("PROXYIP_ORDER_BY", "score"))
+    merge.add_argument('--per-country', type=int, default=int(os.environ.get("PROXYIP_PER_COUNTRY", "0")))
+    args = parser.parse_args(argv)
+    try:
+        dirs = find_shards(args.root)
+    except (OSError, ValueError) as e:
+        print(f"无法合并分片: {e}")
+        return 1
+    merge_shards(dirs, args.allowed, args.output, args.order_by, args.per_country)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding='utf-8')
+    sys.exit(main())
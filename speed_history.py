@@ -0,0 +1,140 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_HISTORY_PATH = os.path.join("cache", "speed_history.db")
+# EWMA 的平滑系数，越大越看重最近几次
+HISTORY_ALPHA = float(os.environ.get("HISTORY_ALPHA", "0.3"))
+# 稳定性惩罚：评分 = 可达率 × (速度均值 - 系数 × 速度标准差)
+STABILITY_PENALTY = float(os.environ.get("STABILITY_PENALTY", "0.5"))
+
+
+class QualityStats:
+    """单个 IP 跨运行的测速统计：速度和延迟的 EWMA、速度的指数加权方差、可达率。"""
+
+    __slots__ = ('runs', 'speed', 'speed_var', 'delay', 'reach', 'country')
+
+    def __init__(self, runs=0, speed=None, speed_var=0.0, delay=None, reach=None, country=None):
+        self.runs = runs
+        self.speed = speed
+        self.speed_var = speed_var
+        self.delay = delay
+        self.reach = reach
+        self.country = country
+
+    def updated(self, speed=None, delay=None, alpha=HISTORY_ALPHA):
+        """返回加入一次新观测后的统计，speed 为 None 表示本次不可达。"""
+        reachable = speed is not None
+        reach = float(reachable) if self.reach is None else (1 - alpha) * self.reach + alpha * reachable
+        if not reachable:
+            return QualityStats(self.runs + 1, self.speed, self.speed_var, self.delay, reach, self.country)
+        if self.speed is None:
+            return QualityStats(self.runs + 1, speed, 0.0, delay, reach, self.country)
+        diff = speed - self.speed
+        # 指数加权的均值和方差（West 的增量公式）
+        mean = self.speed + alpha * diff
+        var = (1 - alpha) * (self.speed_var + alpha * diff * diff)
+        if delay is not None and self.delay is not None:
+            delay = (1 - alpha) * self.delay + alpha * delay
+        return QualityStats(self.runs + 1, mean, var, delay if delay is not None else self.delay,
+                            reach, self.country)
+
+    def score(self, penalty=STABILITY_PENALTY):
+        if self.speed is None or not self.reach:
+            return 0.0
+        return max(0.0, self.reach * (self.speed - penalty * math.sqrt(self.speed_var)))
+
+
+class SpeedHistory:
+    """按 IP 保存历次测速的 EWMA 统计和评分，(country, score) 上有索引，按国家取前 K 名不随历史增长而变慢。"""
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH, alpha=HISTORY_ALPHA, penalty=STABILITY_PENALTY):
+        self.path = path
+        self.alpha = alpha
+        self.penalty = penalty
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ip_quality ("
+            " ip TEXT PRIMARY KEY,"
+            " country TEXT,"
+            " runs INTEGER NOT NULL,"
+            " speed REAL,"
+            " speed_var REAL NOT NULL,"
+            " delay REAL,"
+            " reach REAL NOT NULL,"
+            " score REAL NOT NULL,"
+            " last_speed REAL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ip_quality_country_score ON ip_quality (country, score DESC)")
+        self._conn.commit()
+        self._stats = self._load()
+
+    def _load(self):
+        rows = self._conn.execute(
+            "SELECT ip, runs, speed, speed_var, delay, reach, country FROM ip_quality").fetchall()
+        return {row[0]: QualityStats(*row[1:]) for row in rows}
+
+    def get(self, ip):
+        return self._stats.get(ip)
+
+    def preview(self, ip, speed=None, delay=None):
+        """不写入历史，计算加入本次观测后的评分，供流式筛选即时判断。"""
+        stats = self._stats.get(ip) or QualityStats()
+        return stats.updated(speed, delay, self.alpha).score(self.penalty)
+
+    def record_run(self, observations, countries=None, now=None):
+        """写入一次运行的观测：observations 为 {ip: (速度MB/s, 平均延迟ms)}，速度为 None 表示不可达。
+
+        countries 为 {ip: 国家代码}，只更新已知国家的 IP。返回 {ip: 新评分}。
+        """
+        now = now or time.time()
+        countries = countries or {}
+        rows = []
+        scores = {}
+        for ip, (speed, delay) in observations.items():
+            stats = (self._stats.get(ip) or QualityStats()).updated(speed, delay, self.alpha)
+            stats.country = countries.get(ip) or stats.country
+            self._stats[ip] = stats
+            scores[ip] = stats.score(self.penalty)
+            rows.append((ip, stats.country, stats.runs, stats.speed, stats.speed_var, stats.delay,
+                         stats.reach, scores[ip], speed, now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ip_quality"
+                " (ip, country, runs, speed, speed_var, delay, reach, score, last_speed, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+        return scores
+
+    def scores(self, ips=None):
+        ips = self._stats if ips is None else ips
+        return {ip: self._stats[ip].score(self.penalty) for ip in ips if ip in self._stats}
+
+    def top(self, country, k=10):
+        """某个国家评分最高的 k 个 IP，返回 [(ip, 评分)]。"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT ip, score FROM ip_quality WHERE country = ? ORDER BY score DESC LIMIT ?",
+                (country, k),
+            ).fetchall()
+
+    def top_per_country(self, k=10):
+        """每个国家评分最高的 k 个 IP，返回 {国家代码: [(ip, 评分)]}。"""
+        with self._lock:
+            countries = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT country FROM ip_quality WHERE country IS NOT NULL")]
+        return {country: self.top(country, k) for country in countries}
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
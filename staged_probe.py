@@ -0,0 +1,263 @@
+import asyncio
+import csv
+import os
+import ssl
+import time
+
+from probe import DEFAULT_PORT, iter_in_background, latency_prober
+
+STAGES = ('tcp', 'tls', 'http')
+PROBE_SNI = os.environ.get("PROBE_SNI", "speed.cloudflare.com")
+PROBE_HTTP_PATH = os.environ.get("PROBE_HTTP_PATH", "/cdn-cgi/trace")
+# HTTP 阶段最多读取的响应字节数
+HTTP_RESPONSE_LIMIT = 16 * 1024
+
+
+class StageResult:
+    """单个 IP 的分阶段探测结果：passed 为最后通过的阶段，reason 为被淘汰的原因，timings 为各阶段耗时（毫秒），
+    port 为 TLS / HTTP 阶段使用的端口（多端口探测时为 TCP 延迟最低的端口）。"""
+
+    __slots__ = ('ip', 'port', 'passed', 'reason', 'timings', 'latency', 'colo')
+
+    def __init__(self, ip, port=DEFAULT_PORT):
+        self.ip = ip
+        self.port = port
+        self.passed = None
+        self.reason = None
+        self.timings = {}
+        self.latency = None
+        self.colo = None
+
+    @property
+    def ok(self):
+        return self.reason is None
+
+    def reject(self, stage, reason):
+        self.reason = f"{stage}: {reason}"
+        return self
+
+    def __repr__(self):
+        state = "通过" if self.ok else self.reason
+        return f"StageResult({self.ip}, {state}, {self.timings})"
+
+
+class StageConfig:
+    """各阶段的开关、超时和并发数。ssl_context 默认校验证书，本地测试可传入不校验的 context，
+    或用 ca_file 只信任给定的 CA 证书（如 benchmark 的自签名替身节点）；ca_file 是路径，可随参数传给工作进程。"""
+
+    def __init__(self, stages=STAGES, port=DEFAULT_PORT, sni=PROBE_SNI, http_path=PROBE_HTTP_PATH,
+                 latency_samples=3, timeouts=None, concurrency=None, expect=b"colo=",
+                 ssl_context=None, timeout_policy=None, metrics=None, ports=None, ca_file=None):
+        self.stages = tuple(stage for stage in STAGES if stage in stages)
+        # 多个端口时 TCP 阶段并发探测全部端口，后续阶段只在延迟最低的端口上进行
+        self.ports = ports
+        self.port = ports[0] if ports else port
+        self.sni = sni
+        self.http_path = http_path
+        self.latency_samples = latency_samples
+        self.timeouts = {'tcp': 5, 'tls': 5, 'http': 5}
+        self.timeouts.update(timeouts or {})
+        self.concurrency = {'tcp': 200, 'tls': 100, 'http': 50}
+        self.concurrency.update(concurrency or {})
+        self.expect = expect
+        self.ssl_context = ssl_context or ssl.create_default_context(cafile=ca_file)
+        # 给出时 TCP 阶段使用按分组自适应的超时（见 timeouts.AdaptiveTimeout）
+        self.timeout_policy = timeout_policy
+        self.metrics = metrics
+
+
+async def _close(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (OSError, ssl.SSLError):
+        pass
+
+
+async def _tls_stage(result, config):
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(result.ip, result.port, ssl=config.ssl_context,
+                                    server_hostname=config.sni),
+            config.timeouts['tls'],
+        )
+    except asyncio.TimeoutError:
+        return result.reject('tls', "握手超时"), None
+    except ssl.SSLError as e:
+        return result.reject('tls', e.reason or str(e)), None
+    except OSError as e:
+        return result.reject('tls', str(e)), None
+    result.timings['tls'] = round((time.perf_counter() - start) * 1000, 2)
+    result.passed = 'tls'
+    return result, (reader, writer)
+
+
+async def _read_response(reader, limit=HTTP_RESPONSE_LIMIT):
+    """读取响应直到正文达到 Content-Length、连接关闭或读满 limit 字节；头和正文可能分多个 TCP 段到达。"""
+    data = b""
+    length = None
+    while len(data) < limit:
+        chunk = await reader.read(limit - len(data))
+        if not chunk:
+            break
+        data += chunk
+        head, sep, body = data.partition(b"\r\n\r\n")
+        if not sep:
+            continue
+        if length is None:
+            for line in head.split(b"\r\n")[1:]:
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"content-length" and value.strip().isdigit():
+                    length = int(value.strip())
+        if length is not None and len(body) >= length:
+            break
+    return data
+
+
+async def _http_stage(result, config, connection):
+    start = time.perf_counter()
+    if connection is None:
+        # 未启用 TLS 阶段时以明文连接做 HTTP 检查
+        try:
+            connection = await asyncio.wait_for(
+                asyncio.open_connection(result.ip, result.port), config.timeouts['http'])
+        except (asyncio.TimeoutError, OSError) as e:
+            return result.reject('http', str(e) or "连接超时")
+    reader, writer = connection
+    try:
+        writer.write((
+            f"GET {config.http_path} HTTP/1.1\r\n"
+            f"Host: {config.sni}\r\n"
+            "User-Agent: Mozilla/5.0\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode())
+        await writer.drain()
+        response = await asyncio.wait_for(_read_response(reader), config.timeouts['http'])
+    except (asyncio.TimeoutError, OSError, ssl.SSLError) as e:
+        return result.reject('http', str(e) or "响应超时")
+    finally:
+        await _close(writer)
+    status_line = response.split(b"\r\n", 1)[0].split()
+    if len(status_line) < 2 or status_line[1] != b"200":
+        status = status_line[1].decode(errors='replace') if len(status_line) > 1 else "无响应"
+        return result.reject('http', f"状态码 {status}")
+    if config.expect and config.expect not in response:
+        return result.reject('http', "响应内容不符合预期")
+    for line in response.split(b"\n"):
+        if line.startswith(b"colo="):
+            result.colo = line[5:].strip().decode(errors='replace')
+    result.timings['http'] = round((time.perf_counter() - start) * 1000, 2)
+    result.passed = 'http'
+    return result
+
+
+async def staged_probe(ips, config=None, on_result=None):
+    """TCP → TLS → HTTP 逐级探测，每级有独立的并发池，只有通过的 IP 才进入下一级，返回 {ip: StageResult}。"""
+    config = config or StageConfig()
+    results = {}
+    use_tls = 'tls' in config.stages
+    use_http = 'http' in config.stages
+    tls_queue = asyncio.Queue(maxsize=config.concurrency['tls'] * 2)
+    http_queue = asyncio.Queue(maxsize=config.concurrency['http'] * 2)
+
+    def finish(result):
+        results[result.ip] = result
+        if on_result is not None:
+            on_result(result.ip, result)
+
+    async def forward(result, connection=None):
+        if use_http:
+            await http_queue.put((result, connection))
+        else:
+            if connection is not None:
+                await _close(connection[1])
+            finish(result)
+
+    pending = iter(ips)
+    probe_tcp = latency_prober(config.latency_samples, config.port, config.timeouts['tcp'],
+                               config.timeout_policy, config.metrics, config.ports, config.concurrency['tcp'])
+
+    async def tcp_worker():
+        for ip in pending:
+            result = StageResult(ip, config.port)
+            start = time.perf_counter()
+            result.latency = await probe_tcp(ip)
+            if not result.latency.reachable:
+                finish(result.reject('tcp', "连接失败"))
+                continue
+            result.port = result.latency.port or config.port
+            result.timings['tcp'] = round((time.perf_counter() - start) * 1000, 2)
+            result.passed = 'tcp'
+            if use_tls:
+                await tls_queue.put(result)
+            else:
+                await forward(result)
+
+    async def tls_worker():
+        while True:
+            result = await tls_queue.get()
+            if result is None:
+                return
+            result, connection = await _tls_stage(result, config)
+            if result.ok:
+                await forward(result, connection)
+            else:
+                finish(result)
+
+    async def http_worker():
+        while True:
+            item = await http_queue.get()
+            if item is None:
+                return
+            result, connection = item
+            finish(await _http_stage(result, config, connection))
+
+    tls_workers = [asyncio.create_task(tls_worker()) for _ in range(config.concurrency['tls'] if use_tls else 0)]
+    http_workers = [asyncio.create_task(http_worker()) for _ in range(config.concurrency['http'] if use_http else 0)]
+    await asyncio.gather(*(tcp_worker() for _ in range(config.concurrency['tcp'])))
+    for _ in tls_workers:
+        await tls_queue.put(None)
+    await asyncio.gather(*tls_workers)
+    for _ in http_workers:
+        await http_queue.put(None)
+    await asyncio.gather(*http_workers)
+    return results
+
+
+def iter_staged_probe(ips, config=None):
+    """在后台线程中运行分阶段探测，按完成顺序产出 (ip, StageResult)。"""
+    return iter_in_background(lambda on_result: staged_probe(ips, config, on_result))
+
+
+def summarize(results):
+    """统计各阶段淘汰数量和通过 IP 的平均阶段耗时。"""
+    rejected = {stage: 0 for stage in STAGES}
+    timings = {stage: [] for stage in STAGES}
+    passed = 0
+    for result in results:
+        if result.ok:
+            passed += 1
+        else:
+            rejected[result.reason.split(':', 1)[0]] += 1
+        for stage, elapsed in result.timings.items():
+            timings[stage].append(elapsed)
+    average = {stage: round(sum(values) / len(values), 2) for stage, values in timings.items() if values}
+    return {'passed': passed, 'rejected': rejected, 'average_ms': average}
+
+
+def write_report(path, results):
+    """把每个 IP 的通过阶段、淘汰原因和各阶段耗时写成 CSV。"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ip', 'passed', 'reason', 'tcp_ms', 'tls_ms', 'http_ms', 'colo', 'port'])
+        for result in results:
+            writer.writerow([
+                result.ip, result.passed or '', result.reason or '',
+                *(result.timings.get(stage, '') for stage in STAGES), result.colo or '',
+                result.port if result.passed else '',
+            ])
+    os.replace(tmp_path, path)
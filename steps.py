@@ -0,0 +1,473 @@
+"""采集、检测、筛选、测速和发布各步骤的实现，供 cli.py 的子命令和 DNS2Geo.py / proxyip.py 调用。
+
+dnspython、requests、探测器和测速器都在用到它们的函数内导入，只做本地筛选或发布的命令不必加载网络相关依赖。
+"""
+import sys
+import time
+import os
+import subprocess
+import csv
+from itertools import chain
+
+from records import (
+    PENDING, UNKNOWN, UNREACHABLE, load_allowed_countries, read_latency_file, read_records,
+    records_from_info, write_lines_atomic, write_partitioned_outputs,
+)
+
+# 隔离期满的不可达IP先用一次短超时握手快速复测，仍不通的不再走完整探测
+QUARANTINE_PROBE_TIMEOUT = float(os.environ.get("QUARANTINE_PROBE_TIMEOUT", "1.5"))
+
+def load_country_mapping(file_path):
+    country_mapping = {}
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                parts = line.strip().split(',')
+                if len(parts) == 2:
+                    code, name = parts
+                    country_mapping[code.strip()] = name.replace(" ", "")
+    except FileNotFoundError:
+        print(f"错误: 文件 {file_path} 未找到。")
+    except Exception as e:
+        print(f"加载国家信息时发生错误: {e}")
+    return country_mapping
+
+def _timed(items, metrics, stage, count):
+    """逐个产出 items，只把等待下一个条目的时间计入 stage，调用方处理条目（如查询归属地）的时间不计入。"""
+    items = iter(items)
+    while True:
+        with metrics.stage(stage, count):
+            item = next(items, None)
+        count = 0
+        if item is None:
+            return
+        yield item
+
+def get_country_info(ips, country_mapping, provider):
+    """批量查询归属地，返回 {ip: 国家代码+中文名}，查询失败的记为未知。"""
+    codes = provider.lookup_batch(ips)
+    infos = {}
+    for ip in ips:
+        code = codes.get(ip)
+        if code is None:
+            print(f"无法获取 {ip} 的国家信息。")
+            infos[ip] = "未知"
+            continue
+        name = country_mapping.get(code, "未知")
+        print(f"检测到 IP {ip} 的国家: {code}{name}")
+        infos[ip] = f"{code}{name}"
+    return infos
+
+def collect_all_ips(manual_ip_file, domains_file, output_file, harvester=None, state=None, ranges=None,
+                    metrics=None, shard=None):
+    """采集手动输入（支持单个IP、CIDR 和区间，按 ranges 的采样方式展开）和域名解析得到的IP，按数值顺序返回 {ip: 信息}。
+
+    返回的是数组存储的 IpInfoMap，用法同 dict。
+
+    shard 为 (i, N) 时只保留按IP哈希落在第 i 个分片的IP。
+    """
+    from ip_ranges import IpInfoMap, IpRangeSet
+    from sharding import in_shard
+
+    all_ips = ranges if ranges is not None else IpRangeSet()
+    if os.path.exists(manual_ip_file):
+        with open(manual_ip_file, 'r', encoding='utf-8') as f:
+            all_ips.add_lines(f)
+        print(f"手动输入展开后共 {len(all_ips)} 个IP")
+    if os.path.exists(domains_file):
+        with open(domains_file, 'r', encoding='utf-8') as f:
+            domains = [line.strip() for line in f if line.strip()]
+        if harvester is None:
+            from dns_harvest import DnsHarvester
+            harvester = DnsHarvester()
+        print(f"开始并发解析 {len(domains)} 个域名...")
+        all_ips.add_ips(harvester.resolve_all(domains))
+        summary = harvester.summary()
+        print(f"域名解析完成: 共 {summary['domains']} 个，失败 {summary['failed']} 个")
+        if metrics is not None:
+            metrics.record('dns', 'success', summary['domains'] - summary['failed'])
+            metrics.record('dns', 'failure', summary['failed'])
+        if summary['slowest']:
+            domain, stat = summary['slowest']
+            print(f"最慢的域名: {domain} 耗时 {stat['elapsed']}s")
+    if shard is not None:
+        all_ips = IpRangeSet().add_ips(in_shard(all_ips, shard))
+    # 候选集到增量对比结束都保持数组存储，不为每个IP建字符串字典
+    ip_info = IpInfoMap(all_ips, PENDING)
+    if state is not None:
+        # 增量运行：沿用未过期的上次结果，只有新增或过期的IP标记为未检测
+        ip_info, added, stale, removed = state.diff(ip_info)
+        quarantined = sum(1 for info in ip_info.values() if info == UNREACHABLE)
+        print(f"增量检测: 新增 {added} 个，过期 {stale} 个，移除 {removed} 个，沿用 {len(ip_info) - added - stale} 个"
+              f"（其中 {quarantined} 个不可达IP仍在隔离期内）")
+    if output_file:
+        write_lines_atomic(output_file, (f"{ip}#{info}" for ip, info in ip_info.items()))
+        print(f"所有采集的IP已保存到 {output_file}")
+    return ip_info
+
+def detect_all_ip_country(input_file, output_file, country_mapping,
+                          port=443, timeout=5, concurrency=200, provider=None, batch_size=100,
+                          state=None, ip_info=None, latency_samples=3, stages=None, report_file=None,
+                          timeout_policy=None, metrics=None, deadline=None, allowed=None, processes=1,
+                          ports=None, ca_file=None):
+    """检测未检测IP的握手延迟和归属地，返回 IPRecord 列表；传入 ip_info 时不再读取 input_file。
+
+    stages 为 ('tcp', 'tls', 'http') 的子集时改用分阶段探测，任一阶段被淘汰的IP记为不可达，
+    不再查询归属地；各IP的淘汰原因和阶段耗时写入 report_file。
+    给出 timeout_policy 时握手超时按IP所在网段自适应，timeout 不再生效。
+    给出 metrics 时记录每次握手耗时，以及 probe / geo 两个阶段的成功、失败和不可达数量。
+    有历史状态时按期望收益排序待检测IP（上次属于 allowed 或延迟低的最先）；给出 deadline 时到点停止派发新的探测，
+    未检测到的IP沿用上次结果，也不写回状态，下次运行继续检测。
+    processes 大于 1 时按批分给多个进程探测，每个进程内的并发数仍为 concurrency。
+    上次不可达、隔离期已满的IP排在其余IP之后，先以 QUARANTINE_PROBE_TIMEOUT 超时握手一次，握手成功的才进入完整探测。
+    ports 为要探测的端口（默认 PROBE_PORTS），多个端口时同一IP的各端口并发探测，记录可用端口及其延迟，
+    后续阶段使用延迟最低的端口。ca_file 为 TLS 阶段信任的 CA 证书，默认使用系统证书。
+    """
+    from budget import prioritize, until_expired
+    from multiproc import iter_process_probe
+    from probe import DEFAULT_PORT, PROBE_PORTS, iter_latency_probe
+    from staged_probe import StageConfig, iter_staged_probe, summarize, write_report
+
+    if ip_info is None:
+        ip_info = {record.address: record.info for record in read_records(input_file)}
+    else:
+        ip_info = ip_info.copy()
+    if provider is None:
+        from geo_provider import build_provider
+        provider = build_provider()
+    if ports is None:
+        ports = PROBE_PORTS if port == DEFAULT_PORT else (port,)
+    port = ports[0]
+    pending = [ip for ip, info in ip_info.items() if info == PENDING]
+    # 沿用上次结果的IP同时沿用上次的延迟统计
+    latency = state.load_latency() if state is not None else {}
+    previous = state.load() if state is not None else {}
+    dead = []
+    # 隔离期满的不可达IP排在按收益排序的其余IP之后，不先占用探测预算
+    quarantined = {ip for ip in pending if previous.get(ip, (None,))[0] == UNREACHABLE}
+    main = [ip for ip in pending if ip not in quarantined]
+    if previous:
+        main = prioritize(main, previous, latency, allowed, state.load_unreachable_since())
+
+    def probe(ips, total):
+        ips = ips if deadline is None else until_expired(ips, deadline)
+        if processes > 1:
+            if stages:
+                mode, options = 'staged', {'stages': stages, 'port': port, 'latency_samples': latency_samples,
+                                           'timeouts': {'tcp': timeout}, 'concurrency': {'tcp': concurrency},
+                                           'ports': ports, 'ca_file': ca_file}
+            else:
+                mode, options = 'latency', {'samples': latency_samples, 'port': port, 'timeout': timeout,
+                                            'concurrency': concurrency, 'ports': ports}
+            return iter_process_probe(ips, processes, mode=mode, options=options,
+                                      timeout_policy=timeout_policy, metrics=metrics, total=total)
+        if stages:
+            config = StageConfig(stages=stages, port=port, latency_samples=latency_samples,
+                                 timeout_policy=timeout_policy, metrics=metrics, ports=ports,
+                                 timeouts={'tcp': timeout}, concurrency={'tcp': concurrency}, ca_file=ca_file)
+            return iter_staged_probe(ips, config)
+        return iter_latency_probe(ips, samples=latency_samples, port=port,
+                                  timeout=timeout, concurrency=concurrency,
+                                  timeout_policy=timeout_policy, metrics=metrics, ports=ports)
+
+    def recheck():
+        # 其余IP探测完才执行：先以短超时握手一次，握手成功的才进入完整探测
+        if not quarantined:
+            return
+        recheck_ips = [ip for ip in pending if ip in quarantined]
+        quick = iter_latency_probe(recheck_ips if deadline is None else until_expired(recheck_ips, deadline),
+                                   samples=1, port=port, timeout=QUARANTINE_PROBE_TIMEOUT,
+                                   concurrency=concurrency, metrics=metrics, ports=ports)
+        alive = []
+        for ip, stats in quick:
+            if stats.reachable:
+                alive.append(ip)
+                continue
+            dead.append(ip)
+            latency[ip] = stats
+            ip_info[ip] = UNREACHABLE
+            if metrics is not None:
+                metrics.record('probe', 'unreachable')
+        print(f"隔离期满的不可达IP快速复测 {len(recheck_ips)} 个，仍不可达 {len(dead)} 个")
+        yield from probe(alive, len(alive))
+
+    probe_results = chain(probe(main, len(main)), recheck())
+
+    def lookup(batch):
+        if metrics is None:
+            return get_country_info(batch, country_mapping, provider)
+        with metrics.stage('geo', len(batch)):
+            infos = get_country_info(batch, country_mapping, provider)
+        failed = sum(1 for info in infos.values() if info == UNKNOWN)
+        metrics.record('geo', 'success', len(infos) - failed)
+        metrics.record('geo', 'failure', failed)
+        return infos
+
+    stage_results = []
+    reachable_batch = []
+    probed = []
+    # 并发探测，通过的IP攒满一批就进入归属地查询
+    if metrics is not None:
+        probe_results = _timed(probe_results, metrics, 'probe', len(pending))
+    for ip, result in probe_results:
+        if stages:
+            stage_results.append(result)
+            stats, passed = result.latency, result.ok
+        else:
+            stats, passed = result, result.reachable
+        latency[ip] = stats
+        probed.append(ip)
+        if metrics is not None:
+            metrics.record('probe', 'success' if passed else 'failure' if stats.reachable else 'unreachable')
+        if passed:
+            reachable_batch.append(ip)
+            if len(reachable_batch) >= batch_size:
+                ip_info.update(lookup(reachable_batch))
+                reachable_batch = []
+        else:
+            if stages and stats.reachable:
+                print(f"IP {ip} 未通过探测（{result.reason}），跳过国家信息查询。")
+            else:
+                print(f"IP {ip} 无法连接，跳过国家信息查询。")
+            ip_info[ip] = UNREACHABLE
+    if reachable_batch:
+        ip_info.update(lookup(reachable_batch))
+    if len(probed) + len(dead) < len(pending):
+        print(f"运行时间预算已用完，{len(pending) - len(probed) - len(dead)} 个IP未检测，沿用上次结果")
+        for ip in set(pending).difference(probed, dead):
+            entry = previous.get(ip)
+            if entry is not None and entry[0] not in (PENDING, UNKNOWN):
+                ip_info[ip] = entry[0]
+    if stage_results:
+        summary = summarize(stage_results)
+        print(f"分阶段探测: 通过 {summary['passed']} 个，各阶段淘汰 {summary['rejected']}，"
+              f"平均耗时(ms) {summary['average_ms']}")
+        if report_file:
+            write_report(report_file, stage_results)
+    if state is not None:
+        state.update({ip: ip_info[ip] for ip in dead + probed}, latency=latency)
+    records = records_from_info(ip_info, latency)
+    if output_file:
+        write_partitioned_outputs(records, set(), {'all_with_info': output_file})
+        print(f"所有IP归属地检测完成，已更新到 {output_file}")
+    return records
+
+def extract_ips_from_file(input_file, output_file):
+    try:
+        with open(input_file, 'r', encoding='utf-8') as file:
+            lines = file.readlines()
+        ips = {line.strip().split('#')[0] for line in lines if '#' in line}
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        with open(output_file, 'w', encoding='utf-8') as file:
+            for ip in sorted(ips):
+                file.write(f"{ip}\n")
+        print(f"提取的IP已保存到 {output_file}")
+    except FileNotFoundError:
+        print(f"文件未找到: {input_file}")
+    except Exception as e:
+        print(f"提取出错: {e}")
+
+def filter_ips_by_allowed_countries(
+    input_file, allowed_countries_file, allowed_ip_file, blocked_ip_file,
+    allowed_with_info_file, blocked_with_info_file,
+    unreachable_ip_file,
+    unreachable_with_info_file,
+    latency_file=None,
+    max_p95=None,
+    max_loss=None,
+    sort_by='ip',
+    all_ip_file=None
+):
+    try:
+        allowed = load_allowed_countries(allowed_countries_file)
+        latency = read_latency_file(latency_file)
+        records = read_records(input_file)
+        for record in records:
+            record.latency = latency.get(record.address)
+        paths = {
+            'allowed_ips': allowed_ip_file,
+            'blocked_ips': blocked_ip_file,
+            'allowed_with_info': allowed_with_info_file,
+            'blocked_with_info': blocked_with_info_file,
+            'unreachable_ips': unreachable_ip_file,
+            'unreachable_with_info': unreachable_with_info_file,
+        }
+        if all_ip_file:
+            paths['all_ips'] = all_ip_file
+        allowed_ips, blocked_ips, unreachable_ips = write_partitioned_outputs(
+            records, allowed, paths, max_p95=max_p95, max_loss=max_loss, sort_by=sort_by)
+
+        print("筛选完成：")
+        print(f"✅ 允许: {len(allowed_ips)} 个IP → {allowed_ip_file}, {allowed_with_info_file}")
+        print(f"❌ 拦截: {len(blocked_ips)} 个IP → {blocked_ip_file}, {blocked_with_info_file}")
+        print(f"🚫 不可达: {len(unreachable_ips)} 个IP → {unreachable_ip_file}, {unreachable_with_info_file}")
+
+    except FileNotFoundError as e:
+        print(f"文件缺失: {e}")
+    except Exception as e:
+        print(f"筛选时发生错误: {e}")
+
+def save_ip_txt_for_cloudflarescanner(allowed_ip_file, target_path):
+    try:
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with open(allowed_ip_file, 'r', encoding='utf-8') as fr:
+            lines = fr.readlines()
+        with open(target_path, 'w', encoding='utf-8') as fw:
+            for line in lines:
+                fw.write(line)
+        print(f"已保存 {target_path}")
+    except Exception as e:
+        print(f"保存 {target_path} 时发生错误: {e}")
+
+def run_cloudflarescanner_with_dn(use_exe=None, scanner_dir="CloudflareScanner", targets=None, min_speed=10):
+    """测速 ip.txt 中的IP。内置测速器给出 targets（pipeline.SpeedTargets）时，速度超过 min_speed 的IP达到目标后提前结束。"""
+    exe_path = os.path.join("CloudflareScanner", "CloudflareScanner.exe")
+    ip_txt_path = os.path.join(scanner_dir, "ip.txt")
+    if not os.path.isfile(ip_txt_path):
+        print(f"未找到 {ip_txt_path}")
+        sys.exit(1)
+    # 统计ip.txt行数
+    ip_count = 0
+    with open(ip_txt_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                ip_count += 1
+    # 默认只在 Windows 且存在 EXE 时使用 CloudflareScanner.exe，其余情况使用内置测速器
+    if use_exe is None:
+        use_exe = os.name == 'nt' and os.path.isfile(exe_path)
+    if not use_exe:
+        print(f"使用内置测速器测试 {ip_count} 个IP")
+        from scanner import run_native_scanner
+        kwargs = {}
+        if targets:
+            def on_result(row):
+                if row['Download Speed (MB/s)'] > min_speed:
+                    targets.add(row['IP Address'])
+            kwargs = {'skip': targets.skip, 'on_result': on_result}
+        try:
+            run_native_scanner(ip_txt_path, os.path.join(scanner_dir, "result.csv"),
+                               download_count=ip_count, **kwargs)
+        except Exception as e:
+            print(f"内置测速器运行时发生错误: {e}")
+            sys.exit(1)
+        return
+    if not os.path.isfile(exe_path):
+        print(f"未找到 {exe_path}")
+        sys.exit(1)
+    try:
+        # 改为同步等待EXE结束
+        subprocess.run([exe_path, "-dn", str(ip_count)], cwd="CloudflareScanner")
+        print(f"已启动 {exe_path} -dn {ip_count}")
+    except Exception as e:
+        print(f"运行 {exe_path} 时发生错误: {e}")
+        sys.exit(1)
+
+def wait_for_result_csv(result_csv_path, timeout=600, interval=2):
+    """等待result.csv生成，超时时间单位为秒，默认10分钟。"""
+    print(f"等待 {result_csv_path} 文件生成 ...")
+    waited = 0
+    while waited < timeout:
+        if os.path.isfile(result_csv_path):
+            print(f"{result_csv_path} 已生成，继续执行后续任务。")
+            return True
+        time.sleep(interval)
+        waited += interval
+    print(f"等待超时：{result_csv_path} 仍未生成。")
+    return False
+
+def process_result_csv(
+    input_file='CloudflareScanner/result.csv',
+    proxyip_file='proxyip.txt',
+    with_country_file='proxyip_with_country.txt',
+    countries_file='countries.txt',
+    RETRY=10,
+    provider=None,
+    order_by=None,
+    latency=None,
+    history=None,
+    per_country=0
+):
+    """由 result.csv 生成 proxyip.txt 和 proxyip_with_country.txt。给出 history 时按计入本次结果后的评分筛选，
+    并在查询归属地后连同国家代码写入历史；per_country 限制每个国家最多输出的 IP 数。
+    本次没有达标 IP 时保留上次的输出文件。"""
+    from pipeline import format_proxyip_line, limit_per_country, proxyip_order_key
+    from records import split_address
+
+    if not os.path.isfile(input_file):
+        print('未找到 CloudflareScanner/result.csv，请确认 CloudflareScanner.exe 已成功运行并生成此文件。')
+        sys.exit(1)
+    # 加载国家代码-中文名字典
+    country_dict = {}
+    with open(countries_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.strip().split(',')
+            if len(parts) >= 2:
+                code = parts[0].strip()
+                name = parts[1].strip()
+                country_dict[code] = name
+
+    # 步骤1：筛选Download Speed (MB/s) > 10的IP，并记住速度；有历史时按计入本次结果后的EWMA评分筛选
+    measured = []
+    with open(input_file, 'r', encoding='utf-8') as csvfile:
+        first_line = csvfile.readline()
+        csvfile.seek(0)
+        delimiter = '\t' if '\t' in first_line else ','
+        reader = csv.DictReader(csvfile, delimiter=delimiter)
+        for row in reader:
+            try:
+                speed = float(row.get('Download Speed (MB/s)', '0').strip())
+                ip = row.get('IP Address', '').strip()
+                if ip:
+                    delay = (row.get('Average Delay') or '').strip()
+                    measured.append({'ip': ip, 'speed': speed, 'delay': float(delay) if delay else None})
+            except Exception as e:
+                print(f"Error parsing row: {row}, error: {e}")
+    def value(info):
+        if history is None:
+            return info['speed']
+        return history.preview(info['ip'], info['speed'], info['delay'])
+    valid_infos = [info for info in measured if value(info) > 10]
+
+    # 步骤2：查询国家信息
+    if provider is None:
+        from geo_provider import build_provider
+        provider = build_provider(retries=RETRY)
+    # 测速结果中可能是 ip:端口，归属地按 IP 查询
+    hosts = {info['ip']: split_address(info['ip'])[0] for info in valid_infos}
+    country_codes = provider.lookup_batch(sorted(set(hosts.values())))
+
+    # 步骤3：带着国家代码写入历史，供按国家取评分前列的IP；再排序、按国家限量并输出
+    scores = None
+    if history is not None:
+        countries = {ip: country_codes[host] for ip, host in hosts.items() if country_codes.get(host)}
+        scores = history.record_run({info['ip']: (info['speed'], info['delay']) for info in measured}, countries)
+    if order_by:
+        key = proxyip_order_key(order_by, latency, scores)
+        valid_infos.sort(key=lambda info: key(info['ip'], info['speed']))
+    valid_infos = limit_per_country(valid_infos, per_country,
+                                    lambda info: country_codes.get(hosts[info['ip']], 'Unknown'))
+    if not valid_infos and os.path.isfile(proxyip_file):
+        print(f"本次没有达标的IP，保留上次的 {proxyip_file} 和 {with_country_file}")
+        return
+
+    with open(proxyip_file, 'w', encoding='utf-8') as outfile:
+        for info in valid_infos:
+            outfile.write(info['ip'] + '\n')
+    print(f"筛选完成，共输出 {len(valid_infos)} 个IP到 {proxyip_file}")
+
+    with open(with_country_file, 'w', encoding='utf-8') as outfile:
+        for info in valid_infos:
+            ip = info['ip']
+            speed = info['speed']
+            country_code = country_codes.get(hosts[ip], 'Unknown')
+            line = format_proxyip_line(ip, speed, country_code, country_dict) + "\n"
+            outfile.write(line)
+            print(line.strip())
+
+    print(f"查询国家并格式化输出完成，共输出 {len(valid_infos)} 个IP到 {with_country_file}")
+
+def list_files(prefix=""):
+    print(f"{prefix} 当前目录内容:")
+    for root, dirs, files in os.walk(".", topdown=True):
+        for name in files:
+            print("  ", os.path.join(root, name))
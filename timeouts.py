@@ -0,0 +1,118 @@
+import copy
+import ipaddress
+import json
+import os
+import threading
+from urllib.parse import urlsplit
+
+from probe import percentile
+
+DEFAULT_HISTORY_FILE = os.path.join("cache", "rtt_history.json")
+
+
+def prefix_key(ip):
+    """IPv4 按 /24、IPv6 按 /48 归组。"""
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    prefix = 24 if addr.version == 4 else 48
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+
+def endpoint_key(url):
+    """HTTP 接口按 host:port 归组。"""
+    return urlsplit(url).netloc or url
+
+
+class AdaptiveTimeout:
+    """按分组学习 RTT 分布，把超时设为 高百分位 × 倍数 + 余量，并限制在 [minimum, maximum] 内。
+
+    分组样本不足时退回全局分布，全局样本也不足时使用 maximum。样本跨运行持久化到 history_file。
+    所有时间单位为秒，RTT 样本以毫秒记录。
+    """
+
+    def __init__(self, history_file=DEFAULT_HISTORY_FILE, key_func=prefix_key, pct=95,
+                 multiplier=2.0, margin=0.1, minimum=0.3, maximum=5.0, min_samples=5,
+                 max_samples=64):
+        self.history_file = history_file
+        self.key_func = key_func
+        self.pct = pct
+        self.multiplier = multiplier
+        self.margin = margin
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.samples = self._load()
+        self._global = [rtt for values in self.samples.values() for rtt in values][-max_samples * 16:]
+
+    def __getstate__(self):
+        with self._lock:
+            state = dict(self.__dict__)
+            state['samples'] = {key: list(values) for key, values in self.samples.items()}
+            state['_global'] = list(self._global)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """不写历史文件的副本，用于传给工作进程。"""
+        clone = copy.deepcopy(self)
+        clone.history_file = None
+        return clone
+
+    def _load(self):
+        if not self.history_file or not os.path.isfile(self.history_file):
+            return {}
+        try:
+            with open(self.history_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取RTT历史 {self.history_file} 失败: {e}")
+            return {}
+
+    def save(self):
+        if not self.history_file:
+            return
+        if os.path.dirname(self.history_file):
+            os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
+        tmp_path = f"{self.history_file}.tmp"
+        with self._lock:
+            data = json.dumps(self.samples, separators=(',', ':'), sort_keys=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.history_file)
+
+    def observe(self, target, rtt_ms):
+        key = self.key_func(target)
+        with self._lock:
+            values = self.samples.setdefault(key, [])
+            values.append(round(rtt_ms, 2))
+            if len(values) > self.max_samples:
+                del values[:-self.max_samples]
+            self._global.append(rtt_ms)
+            if len(self._global) > self.max_samples * 16:
+                del self._global[:-self.max_samples * 16]
+
+    def _from_samples(self, values):
+        rtt = percentile(sorted(values), self.pct) / 1000
+        return min(self.maximum, max(self.minimum, rtt * self.multiplier + self.margin))
+
+    def timeout_for(self, target):
+        key = self.key_func(target)
+        with self._lock:
+            values = self.samples.get(key)
+            if values and len(values) >= self.min_samples:
+                return self._from_samples(values)
+            if len(self._global) >= self.min_samples:
+                return self._from_samples(self._global)
+        return self.maximum
+
+    def next_timeout(self, timeout):
+        """一次超时后，下一次尝试把超时翻倍（不超过 maximum），避免误杀慢而可用的主机。"""
+        return min(self.maximum, timeout * 2)